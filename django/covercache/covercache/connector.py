@@ -1,28 +1,41 @@
 import dateutil.parser
 import pymssql
 
+import itertools
+import operator
+import os
 import re
+import threading
+import time
 
 from django.conf import settings
 from django.utils import timezone
 
 
-def get_manifestations():
-    pdb = _Database()
-    rows = pdb.get_manifestations()
-    for row in rows:
-        row['date_updated'] = _convert_MARC_datetime(row['date_updated'])
-    return rows
+def get_manifestations(modified_since=None):
+    """
+    yields the manifestations modified since modified_since in order of id
+    """
+    with _Database() as pdb:
+        for row in pdb.get_manifestations(modified_since=modified_since, stream=True):
+            row['date_updated'] = _convert_MARC_datetime(row['date_updated'])
+            yield row
 
 
-def get_altered_manifestation_id_mapping():
+def get_altered_manifestation_id_mapping(since=None):
     """
-    returns a dictionary which maps the former id(s) of each manifestation to its current id
+    returns a dictionary which maps the former id(s) of each manifestation to its current id,
+    considering only transactions after since if given,
+    along with the date of the latest transaction seen
     """
-    pdb = _Database()
-    change_mapping = {
-        result["NewBibRecordID"]: result["OldBibRecordID"]
-        for result in pdb.get_altered_manifestation_id_mapping()}
+    latest = None
+    change_mapping = {}
+    with _Database() as pdb:
+        for result in pdb.get_altered_manifestation_id_mapping(since):
+            change_mapping[result["NewBibRecordID"]] = result["OldBibRecordID"]
+            transaction_date = timezone.make_aware(result["TranClientDate"])
+            if not latest or transaction_date > latest:
+                latest = transaction_date
     keys = list(change_mapping.keys())
 
     id_mapping = {}
@@ -38,93 +51,292 @@ def get_altered_manifestation_id_mapping():
                 key = change_mapping[key]
                 seen_ids.add(key)
                 id_mapping.update({key: seed})
-    return id_mapping
+    return id_mapping, latest
 
 
 def get_works():
-    pdb = _Database()
-    rows = pdb.get_tags('24', 'a')
     works = {}
-    for row in rows:
-        exp = r'^{}(\d+)$'.format(settings.CONNECTOR['work_prefix'])
-        m = re.match(exp, row['Data'])
-        if m:
-            works.update({row['manifestation_id']: int(m.group(1))})
+    rules = get_identifier_rules()
+    with _Database() as pdb:
+        for row in pdb.get_tags('24', 'a', stream=True):
+            work_id = rules.get_work_id(row['Data'])
+            if work_id is not None:
+                works[row['manifestation_id']] = work_id
     return works
 
 
 def get_identifiers(manifestation_id):
-    identifiers = []
-    pdb = _Database()
-    rows = pdb.get_tags('856', 'u', manifestation_id)
-    provider_indicators = settings.INDICATORS
-    link_indicators = settings.LINKS
-    for row in rows:
-        identifier = {}
-        for source, exp in provider_indicators.items():
-            m = re.search(exp, row['Data'])
+    for _, identifiers in get_identifiers_batch([manifestation_id]):
+        return identifiers
+
+
+def get_identifiers_batch(manifestation_ids=None, modified_since=None):
+    """
+    yields (manifestation_id, identifiers) for every manifestation in manifestation_ids,
+    or for every manifestation modified since modified_since,
+    pulling the 856$u, 020$a and 035$a tags of a whole chunk of manifestations per query
+    """
+    if manifestation_ids is None:
+        with _Database() as pdb:
+            rows = pdb.get_identifier_tags(modified_since=modified_since, stream=True)
+            for manifestation_id, identifiers in _group_identifier_tags(rows):
+                yield manifestation_id, identifiers
+        return
+    manifestation_ids = sorted(set(manifestation_ids))
+    batch_size = settings.CONNECTOR_BATCH_SIZE
+    for i in range(0, len(manifestation_ids), batch_size):
+        chunk = manifestation_ids[i:i + batch_size]
+        with _Database() as pdb:
+            rows = pdb.get_identifier_tags(manifestation_ids=chunk)
+        grouped = dict(_group_identifier_tags(rows))
+        for manifestation_id in chunk:
+            yield manifestation_id, grouped.get(manifestation_id, [])
+
+
+def _group_identifier_tags(rows):
+    #  rows arrive ordered by manifestation, so each manifestation can be parsed as soon as it is complete
+    rules = get_identifier_rules()
+    for manifestation_id, manifestation_rows in itertools.groupby(
+            rows, key=operator.itemgetter('manifestation_id')):
+        yield manifestation_id, rules.parse_rows(manifestation_rows)
+
+
+def get_identifier_rules():
+    """
+    returns the identifier rules compiled from the indicators, links and work prefix in the settings,
+    compiling them on first use
+    """
+    global _identifier_rules
+    if _identifier_rules is None:
+        _identifier_rules = IdentifierRules(
+            settings.INDICATORS,
+            settings.LINKS,
+            settings.CONNECTOR['work_prefix'])
+    return _identifier_rules
+
+
+class IdentifierRules(object):
+    """
+    turns MARC tag rows into identifiers, with every pattern compiled once up front:
+    856$u urls are matched against the provider indicators and link patterns,
+    020$a against isbns, 035$a against oclc numbers, and 024$a against the work prefix
+    """
+    ISBN = re.compile(r'\S*')
+    NOT_ISBN_CHARACTER = re.compile(r'[^X0-9]')
+    ISBN10 = re.compile(r'^\d{9}[\dX]$')
+    ISBN13 = re.compile(r'^\d{13}$')
+    OCLC = re.compile(r'^\(OCoLC\)\s*[ocnm]*(\d+)\s*$')
+
+    def __init__(self, indicators, links, work_prefix):
+        self.indicators = [
+            (source, re.compile(exp))
+            for source, exp in indicators.items()
+        ]
+        self.links = [
+            (re.compile(link['url']), [
+                (re.compile(k), v)
+                for k, v in link.get('sub', {}).items()
+            ])
+            for link in links
+        ]
+        self.work = re.compile(r'^{}(\d+)$'.format(work_prefix))
+        self.parsers = {
+            856: self.parse_856u,
+            20: self.parse_020a,
+            35: self.parse_035a,
+        }
+
+    def parse_rows(self, rows):
+        """
+        returns the identifiers in a batch of rows of tags 856, 020 and 035
+        """
+        identifiers = []
+        parsers = self.parsers
+        for row in rows:
+            parser = parsers.get(int(row['TagNumber']))
+            if parser:
+                identifiers.extend(parser(row['Data']))
+        return identifiers
+
+    def parse_856u(self, data):
+        identifiers = []
+        for source, exp in self.indicators:
+            m = exp.search(data)
             if m:
-                identifier['value'] = m.group(1)
-                identifier['source'] = source
-                identifiers.append(identifier)
-        for link_indicator in link_indicators:
-            exp = link_indicator['url']
-            m = re.match(exp, row['Data'])
+                identifiers.append({'source': source, 'value': m.group(1)})
+        for exp, subs in self.links:
+            m = exp.match(data)
             if m:
-                identifier_value = m.group()
-                identifier['source'] = 'link'
-                if link_indicator.get('sub'):
-                    for k, v in link_indicator['sub'].items():
-                        identifier_value = re.sub(k, v, identifier_value)
-                identifier['value'] = identifier_value
-                identifiers.append(identifier)
-
-    rows = pdb.get_tags('20', 'a', manifestation_id)
-    for row in rows:
-        identifier = {'source': 'isbn'}
-        m = re.match(r'\S*', row['Data'])
+                value = m.group()
+                for sub, replacement in subs:
+                    value = sub.sub(replacement, value)
+                identifiers.append({'source': 'link', 'value': value})
+        return identifiers
+
+    def parse_020a(self, data):
+        isbn = self.NOT_ISBN_CHARACTER.sub('', self.ISBN.match(data).group())
+        if self.ISBN10.match(isbn) and _isbn10_check_digit(isbn[:-1]) == isbn[-1]:
+            isbn = _isbn_convert_10_to_13(isbn)
+        if self.ISBN13.match(isbn) and _isbn13_check_digit(isbn[:-1]) == isbn[-1]:
+            return [{'source': 'isbn', 'value': isbn}]
+        return []
+
+    def parse_035a(self, data):
+        m = self.OCLC.match(data)
         if m:
-            isbn = re.sub(r'[^X0-9]', '', m.group())
-            if len(isbn) == 10 and _isbn10_check_digit(isbn[:-1]) == isbn[-1]:
-                isbn = _isbn_convert_10_to_13(isbn)
-            if len(isbn) == 13 and _isbn13_check_digit(isbn[:-1]) == isbn[-1]:
-                identifier.update({'value': isbn})
-                identifiers.append(identifier)
-
-    rows = pdb.get_tags('35', 'a', manifestation_id)
-    for row in rows:
-        identifier = {'source': 'oclc'}
-        m = re.match(r'^\(OCoLC\)\s*[ocnm]*(\d+)\s*$', row['Data'])
+            return [{'source': 'oclc', 'value': m.group(1)}]
+        return []
+
+    def get_work_id(self, data):
+        m = self.work.match(data)
         if m:
-            oclc = m.group(1)
-            identifier.update({'value': oclc})
-            identifiers.append(identifier)
-    return identifiers
+            return int(m.group(1))
 
 
-class _Database(object):
-    _connection = None
-    _cursor = None
+_identifier_rules = None
 
-    def __init__(self):
+
+def get_pool_stats():
+    return _pool.get_stats()
+
+
+class _ConnectionPool(object):
+    """
+    keeps idle Polaris connections around for reuse within a worker process,
+    with at most max_size connections checked out at any one time
+    """
+
+    def __init__(self, max_size, health_check_interval):
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._idle = []
+        self.connects = 0
+        self.reuses = 0
+        self.discards = 0
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            # connections inherited from the parent of a forked worker must not be shared
+            self._reset()
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, last_used = self._idle.pop()
+                if self._is_healthy(connection, last_used):
+                    self.reuses += 1
+                    return connection
+                self._close(connection)
+            connection = self._connect()
+            self.connects += 1
+            return connection
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection, discard=False):
+        if discard:
+            self._close(connection)
+        else:
+            with self._lock:
+                self._idle.append((connection, time.time()))
+        self._slots.release()
+
+    def get_stats(self):
+        return {
+            'connects': self.connects,
+            'reuses': self.reuses,
+            'discards': self.discards,
+            'idle': len(self._idle),
+            'max_size': self.max_size,
+        }
+
+    def _connect(self):
         connector = settings.CONNECTOR
-        self._connection = pymssql.connect(
+        return pymssql.connect(
             connector['ip_address'],
             connector['user'],
             connector['password'],
             connector['database'],
-            port=connector['port'])
+            port=connector['port'],
+            autocommit=True)
+
+    def _is_healthy(self, connection, last_used):
+        if time.time() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        except pymssql.Error:
+            return False
+        return True
+
+    def _close(self, connection):
+        self.discards += 1
+        try:
+            connection.close()
+        except pymssql.Error:
+            pass
+
+
+_pool = _ConnectionPool(
+    settings.CONNECTOR_POOL_SIZE,
+    settings.CONNECTOR_POOL_HEALTH_CHECK_INTERVAL)
+
+
+class _Database(object):
+    _connection = None
+    _cursor = None
+    _streaming = False
+
+    def __init__(self):
+        self._connection = _pool.acquire()
         self._cursor = self._connection.cursor(as_dict=True)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None and issubclass(exc_type, pymssql.Error))
+
     def __del__(self):
-        self._connection.close()
+        self.close()
 
-    def query(self, query, params=None):
+    def close(self, discard=False):
+        if self._connection is not None:
+            connection = self._connection
+            self._connection = None
+            self._cursor = None
+            #  a connection abandoned halfway through a streamed result set cannot be reused
+            _pool.release(connection, discard=discard or self._streaming)
+
+    def query(self, query, params=None, stream=False):
         self._cursor.execute(query, params)
+        if stream:
+            self._streaming = True
+            return self._stream(self._cursor)
         results = self._cursor.fetchall()
         return results
 
-    def get_manifestations(self):
+    def _stream(self, cursor):
+        while True:
+            results = cursor.fetchmany(settings.CONNECTOR_FETCH_SIZE)
+            if not results:
+                break
+            for result in results:
+                yield result
+        self._streaming = False
+
+    def get_manifestations(self, modified_since=None, stream=False):
         query = """
                 SELECT
                     BibliographicRecordID AS manifestation_id,
@@ -135,10 +347,17 @@ class _Database(object):
                 JOIN Polaris.Polaris.MARCTypeOfMaterial
                     AS tom WITH (NOLOCK)
                 ON br.PrimaryMARCTOMID = tom.MARCTypeOfMaterialID"""
-        results = self.query(query)
+        params = None
+        if modified_since is not None:
+            query += """
+                WHERE br.MARCModificationDate >= %s"""
+            params = (_convert_datetime_MARC(modified_since),)
+        query += """
+                ORDER BY br.BibliographicRecordID"""
+        results = self.query(query, params, stream=stream)
         return results
 
-    def get_tags(self, tag_number, subfield, manifestation_id=None):
+    def get_tags(self, tag_number, subfield, manifestation_id=None, stream=False):
         if manifestation_id:
             query = """
                     SELECT
@@ -153,7 +372,7 @@ class _Database(object):
                         AND sub.Subfield = %s
                         AND tag.BibliographicRecordID = %s"""
             params = (tag_number, subfield, manifestation_id)
-            results = self.query(query, params)
+            results = self.query(query, params, stream=stream)
         else:
             query = """
                     SELECT
@@ -168,10 +387,44 @@ class _Database(object):
                         tag.TagNumber = %s
                         AND sub.Subfield = %s"""
             params = (tag_number, subfield)
-            results = self.query(query, params)
+            results = self.query(query, params, stream=stream)
+        return results
+
+    def get_identifier_tags(self, manifestation_ids=None, modified_since=None, stream=False):
+        query = """
+                SELECT
+                    tag.BibliographicRecordID AS manifestation_id,
+                    tag.TagNumber,
+                    Data
+                FROM Polaris.Polaris.BibliographicTags
+                    AS tag WITH (NOLOCK)
+                LEFT OUTER JOIN Polaris.Polaris.BibliographicSubfields
+                    AS sub WITH (NOLOCK)
+                    ON tag.BibliographicTagID = sub.BibliographicTagID
+                JOIN Polaris.Polaris.BibliographicRecords
+                    AS br WITH (NOLOCK)
+                    ON tag.BibliographicRecordID = br.BibliographicRecordID
+                WHERE
+                    (
+                        (tag.TagNumber = 856 AND sub.Subfield = 'u')
+                        OR (tag.TagNumber = 20 AND sub.Subfield = 'a')
+                        OR (tag.TagNumber = 35 AND sub.Subfield = 'a')
+                    )"""
+        params = ()
+        if manifestation_ids is not None:
+            query += """
+                    AND tag.BibliographicRecordID IN %s"""
+            params += (tuple(manifestation_ids),)
+        if modified_since is not None:
+            query += """
+                    AND br.MARCModificationDate >= %s"""
+            params += (_convert_datetime_MARC(modified_since),)
+        query += """
+                ORDER BY tag.BibliographicRecordID"""
+        results = self.query(query, params or None, stream=stream)
         return results
 
-    def get_altered_manifestation_id_mapping(self):
+    def get_altered_manifestation_id_mapping(self, since=None):
         query = """
             SELECT
                 td.numValue AS OldBibRecordID,
@@ -229,18 +482,24 @@ class _Database(object):
                     th.TransactionTypeID = 3001
                     AND td1.numValue IS NOT NULL
                     AND td1.numValue > 0"""
-        results = self.query(query)
+        params = None
+        if since is not None:
+            query = """
+            SELECT * FROM ({}
+            ) AS changes
+            WHERE changes.TranClientDate > %s""".format(query)
+            params = (timezone.make_naive(since),)
+        results = self.query(query, params)
         return results
 
 
+_ISBN10_WEIGHTS = range(1, 10)
+_ISBN13_WEIGHTS = (1, 3) * 6
+
+
 def _isbn10_check_digit(isbn):
     assert len(isbn) == 9
-    sum = 0
-    for i in range(len(isbn)):
-        c = int(isbn[i])
-        w = i + 1
-        sum += w * c
-    r = sum % 11
+    r = sum(map(operator.mul, map(int, isbn), _ISBN10_WEIGHTS)) % 11
     if r == 10:
         return 'X'
     else:
@@ -249,15 +508,7 @@ def _isbn10_check_digit(isbn):
 
 def _isbn13_check_digit(isbn):
     assert len(isbn) == 12
-    sum = 0
-    for i in range(len(isbn)):
-        c = int(isbn[i])
-        if i % 2:
-            w = 3
-        else:
-            w = 1
-        sum += w * c
-    r = 10 - (sum % 10)
+    r = 10 - sum(map(operator.mul, map(int, isbn), _ISBN13_WEIGHTS)) % 10
     if r == 10:
         return '0'
     else:
@@ -274,3 +525,7 @@ def _isbn_convert_10_to_13(isbn):
 def _convert_MARC_datetime(s):
     t = '{}-{}-{} {}:{}'.format(s[:4], s[4:6], s[6:8], s[8:10], s[10:12])
     return timezone.make_aware(dateutil.parser.parse(t))
+
+
+def _convert_datetime_MARC(d):
+    return timezone.localtime(d).strftime('%Y%m%d%H%M')
@@ -0,0 +1,88 @@
+"""
+pooled keep-alive sessions shared by every outbound request to the cover sources,
+one per source and host, with per source timeouts and retries
+"""
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get(url, source=None, **kwargs):
+    return request('GET', url, source=source, **kwargs)
+
+
+def post(url, source=None, **kwargs):
+    return request('POST', url, source=source, **kwargs)
+
+
+def request(method, url, source=None, **kwargs):
+    options = _get_options(source)
+    kwargs.setdefault('timeout', tuple(options['timeout']))
+    return _get_session(url, source, options).request(method, url, **kwargs)
+
+
+def get_pool_stats():
+    """
+    returns, per host, how many requests reused a pooled connection (hits)
+    and how many had to open a new one (misses)
+    """
+    stats = {}
+    with _lock:
+        sessions = list(_sessions.values())
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host_stats = stats.setdefault(pool.host, {'hits': 0, 'misses': 0})
+                host_stats['hits'] += max(pool.num_requests - pool.num_connections, 0)
+                host_stats['misses'] += pool.num_connections
+    return stats
+
+
+def _get_options(source):
+    options = {
+        'timeout': settings.HTTP_TIMEOUT,
+        'retries': settings.HTTP_RETRIES,
+        'backoff_factor': settings.HTTP_BACKOFF_FACTOR,
+    }
+    options.update(settings.HTTP_SOURCES.get(source, {}))
+    return options
+
+
+def _get_session(url, source, options):
+    parts = urlsplit(url)
+    key = (source, parts.scheme, parts.netloc)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _build_session(options)
+            _sessions[key] = session
+    return session
+
+
+def _build_session(options):
+    retry = Retry(
+        total=options['retries'],
+        backoff_factor=options['backoff_factor'],
+        status_forcelist=[500, 502, 503, 504],
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+        max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
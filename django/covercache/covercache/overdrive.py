@@ -1,7 +1,21 @@
-import requests
 from base64 import b64encode
+import json
+import threading
+import time
+import uuid
+
 from django.conf import settings
 
+from . import httpclient, redisclient
+
+# deletes the lock only if it is still held by the process releasing it
+_RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 
 class OverdriveAPI(object):
 
@@ -12,51 +26,125 @@ class OverdriveAPI(object):
     client_secret = settings.OVERDRIVE['client_secret']
     collection_id = settings.OVERDRIVE['collection_id']
 
+    token_cache_key = 'overdrive:token'
+    token_lock_key = 'overdrive:token:lock'
+    token_lock_timeout = 30
+    token_refresh_margin = settings.OVERDRIVE.get('token_refresh_margin', 60)
+
+    # shared by every instance in the process, backed by redis across processes, containers and nodes
+    _token = None
+    _token_lock = threading.Lock()
+
     def __init__(self, barcode=None):
-        self.has_token = False
+        pass
 
     def _exec_request(self, http_method, root_uri, suffix_uri, **kwargs):
         # This is the heart of the API wrapper. All the Overdrive API methods
         # take their method specific input and parse it and call this method
         # which then constructs and sends the appropriate request.
-        params = kwargs.get('params', {})
-        if not self.has_token and not self._get_token():
+        token = self._get_cached_token()
+        if not token:
             return
+        res = self._send_request(token, http_method, root_uri, suffix_uri, **kwargs)
+        if res.status_code == 401:
+            # the token was revoked or expired early, so refresh it and retry once
+            token = self._get_cached_token(rejected_token=token)
+            if not token:
+                return
+            res = self._send_request(token, http_method, root_uri, suffix_uri, **kwargs)
+        return res
+
+    def _send_request(self, token, http_method, root_uri, suffix_uri, **kwargs):
+        params = kwargs.get('params', {})
         uri = root_uri + suffix_uri
         headers = {
             'Authorization': '{token_type} {access_token}'.format(
-                token_type=self.token_type.title(),
-                access_token=self.access_token),
+                token_type=token['token_type'].title(),
+                access_token=token['access_token']),
             'Content-Type': 'application/json; charset=utf-8'
         }
         data = kwargs.get('data', '')
-        return requests.request(
+        return httpclient.request(
             http_method,
             uri,
+            source='overdrive',
             headers=headers,
             data=data,
             params=params,
         )
 
-    def _get_token(self):
+    @classmethod
+    def _is_usable(cls, token, rejected_token=None):
+        if not token:
+            return False
+        if rejected_token and token['access_token'] == rejected_token['access_token']:
+            return False
+        return token['expires_at'] - cls.token_refresh_margin > time.time()
+
+    @classmethod
+    def _get_cached_token(cls, rejected_token=None):
+        if cls._is_usable(cls._token, rejected_token):
+            return cls._token
+        with cls._token_lock:
+            if cls._is_usable(cls._token, rejected_token):
+                return cls._token
+            token = cls._load_token()
+            if not cls._is_usable(token, rejected_token):
+                token = cls._refresh_token(rejected_token)
+            cls._token = token
+            return token
+
+    @classmethod
+    def _load_token(cls):
+        token = redisclient.get_client().get(cls.token_cache_key)
+        if token:
+            return json.loads(token.decode('utf-8'))
+
+    @classmethod
+    def _refresh_token(cls, rejected_token=None):
+        # SET NX only succeeds for one process at a time, the others wait for its token
+        client = redisclient.get_client()
+        lock = uuid.uuid4().hex
+        deadline = time.time() + cls.token_lock_timeout
+        while not client.set(cls.token_lock_key, lock, ex=cls.token_lock_timeout, nx=True):
+            time.sleep(0.1)
+            token = cls._load_token()
+            if cls._is_usable(token, rejected_token):
+                return token
+            if time.time() > deadline:
+                lock = None
+                break
+        try:
+            token = cls._get_token()
+            if token:
+                client.set(
+                    cls.token_cache_key,
+                    json.dumps(token),
+                    ex=max(int(token['expires_at'] - time.time() - cls.token_refresh_margin), 1))
+            return token
+        finally:
+            if lock:
+                client.eval(_RELEASE_LOCK, 1, cls.token_lock_key, lock)
+
+    @classmethod
+    def _get_token(cls):
         signature = b64encode('{}:{}'.format(
-            self.client_id,
-            self.client_secret).encode('utf-8')).decode('ascii')
+            cls.client_id,
+            cls.client_secret).encode('utf-8')).decode('ascii')
         headers = {
             'Authorization': 'Basic {signature}'.format(signature=signature),
             'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'
         }
         data = "grant_type=client_credentials"
         uri = "https://oauth.overdrive.com/token"
-        res = requests.post(uri, headers=headers, data=data)
+        res = httpclient.post(uri, source='overdrive', headers=headers, data=data)
         if res.status_code == 200:
             token_info = res.json()
-            self.access_token = token_info['access_token']
-            self.token_type = token_info['token_type']
-            self.has_token = True
-        else:
-            self.has_token = False
-        return self.has_token
+            return {
+                'access_token': token_info['access_token'],
+                'token_type': token_info['token_type'],
+                'expires_at': time.time() + int(token_info.get('expires_in', 3600)),
+            }
 
     def get_metadata(self, item_id):
         http_method = 'GET'
@@ -0,0 +1,16 @@
+import redis
+
+from django.conf import settings
+
+
+_client = None
+
+
+def get_client():
+    """
+    returns the client of the redis instance shared by every worker on every node
+    """
+    global _client
+    if _client is None:
+        _client = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _client
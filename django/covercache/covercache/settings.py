@@ -128,13 +128,66 @@ CACHES = {
 
 # COVERS Settings
 IMAGE_WIDTH = config['image_width']
+# larger images are rejected before being decoded
+IMAGE_MAX_PIXELS = config.get('image_max_pixels', 50000000)
+IMAGE_MAX_BYTES = config.get('image_max_bytes', 10 * 1024 * 1024)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# unread bodies up to this size are read to the end so that their connection can be reused
+DOWNLOAD_DRAIN_MAX_BYTES = config.get('download_drain_max_bytes', 256 * 1024)
+IMAGE_QUALITY = config.get('image_quality', 75)
+# 0 processes images in the fetching thread
+IMAGE_PROCESSING_WORKERS = config.get('image_processing_workers', 2)
+# seconds to wait for an image to be processed before treating it as unusable
+IMAGE_PROCESSING_TIMEOUT = config.get('image_processing_timeout', 30)
 RETRY_PERIOD = config['retry_period']
+# repeated misses back off exponentially from RETRY_PERIOD up to MAX_RETRY_PERIOD days,
+# transient errors are retried after TRANSIENT_RETRY_PERIOD minutes
+MAX_RETRY_PERIOD = config.get('max_retry_period', RETRY_PERIOD * 16)
+TRANSIENT_RETRY_PERIOD = config.get('transient_retry_period', 60)
+BULK_UPDATE_SIZE = config.get('bulk_update_size', 500)
+BATCH_LOOKUP_LIMIT = config.get('batch_lookup_limit', 100)
+# widths /works/{id}/cover.jpg?width= may be scaled down to
+COVER_RENDITION_WIDTHS = config.get('cover_rendition_widths', [])
+# seconds a queued rendition is not queued again for
+RENDITION_LOCK_TIMEOUT = 10 * 60
+# path under MEDIA_ROOT served when a work has no cover, 404 when unset
+PLACEHOLDER_COVER = config.get('placeholder_cover')
+COVER_MAX_AGE = config.get('cover_max_age', 24 * 60 * 60)
+# internal nginx location aliasing MEDIA_ROOT
+X_ACCEL_REDIRECT_PREFIX = '/protected-media/'
 SOURCE_PRECEDENCE = config['sources']
 CONNECTOR = config['connector']
+CONNECTOR_BATCH_SIZE = config.get('connector_batch_size', 1000)
+CONNECTOR_FETCH_SIZE = config.get('connector_fetch_size', 5000)
+CONNECTOR_POOL_SIZE = config.get('connector_pool_size', 4)
+CONNECTOR_POOL_HEALTH_CHECK_INTERVAL = config.get('connector_pool_health_check_interval', 60)
 INDICATORS = config['indicators']
 LINKS = config['links']
 
 # SOURCE Settings
+# per source caps, e.g. {"amazon": {"requests": 10, "period": 1, "concurrency": 4}}
+SOURCE_LIMITS = config.get('source_limits', {})
+THROTTLE_SLOT_TIMEOUT = 300
+THROTTLE_POLL_INTERVAL = 0.1
+HARVEST_CHUNK_SIZE = config.get('harvest_chunk_size', 100)
+# seconds a dequeued harvest batch is held by its worker before other workers may take it
+HARVEST_LEASE_TIMEOUT = config.get('harvest_lease_timeout', 60 * 60)
+# seconds after which an unfinished maintenance run is abandoned rather than resumed
+MAINTENANCE_RUN_MAX_AGE = config.get('maintenance_run_max_age', 2 * 24 * 60 * 60)
+# seconds after which a stage which has not finished is assumed to have died with its worker
+MAINTENANCE_STAGE_TIMEOUT = config.get('maintenance_stage_timeout', 12 * 60 * 60)
+PROBE_WORKERS = config.get('probe_workers', 8)
+# seconds a poll of every source may take, kept below gunicorn's 30 second worker timeout
+POLL_TIMEOUT = config.get('poll_timeout', 20)
+
+# HTTP Settings
+# (connect, read) timeouts in seconds
+HTTP_TIMEOUT = config.get('http_timeout', [3.05, 10])
+HTTP_RETRIES = config.get('http_retries', 2)
+HTTP_BACKOFF_FACTOR = config.get('http_backoff_factor', 0.5)
+HTTP_POOL_MAXSIZE = config.get('http_pool_maxsize', 10)
+# per source overrides of the above, e.g. {"worldcat": {"timeout": [3.05, 30], "retries": 0}}
+HTTP_SOURCES = config.get('http_sources', {})
 OVERDRIVE = config['overdrive']
 SYNDETICS = config['syndetics']
 WORLDCAT = config['worldcat']
@@ -142,6 +195,12 @@ ZOLA = config['zola']
 
 # RECOMMENDATION Settings
 RECOMMENDATIONS = config['recommendations']
+# seconds before stored recommendations are refreshed
+RECOMMENDATIONS_TTL = RECOMMENDATIONS.get('ttl', 7 * 24 * 60 * 60)
+RECOMMENDATIONS_REFRESH_BATCH_SIZE = RECOMMENDATIONS.get('refresh_batch_size', 1000)
+RECOMMENDATIONS_REFRESH_LOCK_TIMEOUT = 10 * 60
+# seconds the isbn to work index in redis is kept before it is rebuilt
+ISBN_INDEX_TIMEOUT = RECOMMENDATIONS.get('isbn_index_timeout', 24 * 60 * 60)
 
 # REST Framework Settings
 REST_FRAMEWORK = {
@@ -154,8 +213,9 @@ REST_FRAMEWORK = {
 }
 
 # Celery Settings
+REDIS_URL = 'redis://redis'
 BROKER_URL = 'amqp://guest@rabbitmq'
-CELERY_RESULT_BACKEND = 'redis://redis'
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
@@ -166,4 +226,8 @@ CELERYBEAT_SCHEDULE = {
         'task': 'covers.tasks.maintain',
         'schedule': crontab(minute=0, hour=3),
     },
+    'covers.tasks.refresh_stale_recommendations': {
+        'task': 'covers.tasks.refresh_stale_recommendations',
+        'schedule': crontab(minute=30),
+    },
 }
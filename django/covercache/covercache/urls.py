@@ -24,6 +24,7 @@ router.register(r'works', WorkViewSet)
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^works/(?P<pk>[^/.]+)/cover\.jpg$', WorkViewSet.as_view({'get': 'cover'}), name='work-cover'),
     # url(r'^search/', include('search.urls', namespace="search")),
 ]
 
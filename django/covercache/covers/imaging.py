@@ -0,0 +1,110 @@
+"""
+decoding, downscaling and re-encoding of fetched cover images,
+run in a process pool so that CPU work does not hold up the fetching threads;
+celery's pool processes cannot start one, so there it runs inline in the harvesting task's own process
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import os
+import threading
+import time
+
+from PIL import Image
+
+from django.conf import settings
+
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class ProcessingTimeout(Exception):
+    """
+    the image may well be fine, so the probe is a transient failure rather than a miss
+    """
+
+
+def process(content):
+    """
+    returns a dictionary of the processed JPEG content, its dimensions and timings,
+    or None if the content is not an acceptable cover image,
+    raising ProcessingTimeout if the pool did not process it in time
+    """
+    args = (
+        content,
+        settings.IMAGE_WIDTH,
+        settings.IMAGE_MAX_PIXELS,
+        settings.IMAGE_MAX_BYTES,
+        settings.IMAGE_QUALITY)
+    executor = _get_executor()
+    if executor is not None:
+        try:
+            return executor.submit(process_image, *args).result(timeout=settings.IMAGE_PROCESSING_TIMEOUT)
+        except TimeoutError:
+            raise ProcessingTimeout()
+        except (AssertionError, BrokenProcessPool, OSError):
+            # celery's daemonic pool processes may not start processes of their own
+            _disable_executor()
+    return process_image(*args)
+
+
+def process_image(content, width, max_pixels, max_bytes, quality):
+    if len(content) > max_bytes:
+        return
+    start = time.time()
+    try:
+        image = Image.open(BytesIO(content))
+        if image.width * image.height > max_pixels or image.width < width:
+            return
+        size = (width, int(width * image.height / image.width))
+        # lets the JPEG decoder scale down by a power of two while decoding
+        image.draft('RGB', size)
+        image = image.convert('RGB')
+    except (OSError, ValueError):
+        # in case sources return files that are not images, or are truncated
+        return
+    decoded = time.time()
+    image = image.resize(size, Image.ANTIALIAS)
+    output_bytes = BytesIO()
+    image.save(output_bytes, 'JPEG', quality=quality, optimize=True, progressive=True)
+    encoded = time.time()
+    return {
+        'content': output_bytes.getvalue(),
+        'width': image.width,
+        'height': image.height,
+        'decode_time': decoded - start,
+        'encode_time': encoded - decoded,
+    }
+
+
+def resize(content, width, quality):
+    """
+    returns content scaled down to width as JPEG content
+    """
+    image = Image.open(BytesIO(content))
+    size = (width, int(width * image.height / image.width))
+    image.draft('RGB', size)
+    image = image.convert('RGB').resize(size, Image.ANTIALIAS)
+    output_bytes = BytesIO()
+    image.save(output_bytes, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return output_bytes.getvalue()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if not settings.IMAGE_PROCESSING_WORKERS:
+        return
+    with _lock:
+        if _executor_pid != os.getpid():
+            # a pool inherited from the parent of a forked worker cannot be used
+            _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_PROCESSING_WORKERS)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _disable_executor():
+    global _executor
+    with _lock:
+        _executor = None
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.files.images import get_image_dimensions
+from django.core.management.base import BaseCommand
+
+from covers.models import Cover, Work, WorkCoverIndex
+
+
+class Command(BaseCommand):
+    help = (
+        'Stores the dimensions and size of covers saved before they were recorded, '
+        'and recomputes every source rank from SOURCE_PRECEDENCE')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='re-read the dimensions of every cover, not only of those missing them')
+
+    def handle(self, *args, **options):
+        reranked_sources = []
+        for source in Cover.objects.values_list('source', flat=True).distinct():
+            if Cover.objects.filter(source=source).exclude(rank=Cover.get_rank(source)).update(
+                    rank=Cover.get_rank(source)):
+                reranked_sources.append(source)
+        # the indexes of works with reranked covers list them in the old order
+        work_ids = list(Work.objects.filter(
+            manifestations__identifiers__covers__source__in=reranked_sources).values_list(
+                'id', flat=True).distinct())
+        for i in range(0, len(work_ids), settings.BULK_UPDATE_SIZE):
+            WorkCoverIndex.refresh(work_ids[i:i + settings.BULK_UPDATE_SIZE])
+
+        covers = Cover.objects.all()
+        if not options['all']:
+            covers = covers.filter(width__isnull=True)
+        backfilled = 0
+        for cover in covers.iterator():
+            try:
+                cover.image.open('rb')
+                width, height = get_image_dimensions(cover.image)
+                size = cover.image.size
+            except (IOError, OSError):
+                self.stderr.write('missing image {} for cover {}'.format(cover.image.name, cover.pk))
+                continue
+            finally:
+                cover.image.close()
+            # update rather than save, so that date_modified keeps describing the image
+            Cover.objects.filter(pk=cover.pk).update(width=width, height=height, size=size)
+            backfilled += 1
+
+        self.stdout.write('ranked covers by {}, reindexed {} works, backfilled {} covers'.format(
+            ', '.join(settings.SOURCE_PRECEDENCE),
+            len(work_ids),
+            backfilled))
@@ -0,0 +1,45 @@
+import timeit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from covercache import connector
+
+
+class Command(BaseCommand):
+    help = 'Times the parsing of synthetic MARC tag rows into identifiers and work ids'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=100000,
+            help='number of tag rows to parse per repetition')
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='number of repetitions, the fastest of which is reported')
+
+    def handle(self, *args, **options):
+        rules = connector.get_identifier_rules()
+        samples = [
+            {'TagNumber': 20, 'Data': '0306406152 (pbk.)'},
+            {'TagNumber': 20, 'Data': '9780306406157'},
+            {'TagNumber': 20, 'Data': '030640615X'},
+            {'TagNumber': 35, 'Data': '(OCoLC)ocm12345678'},
+            {'TagNumber': 35, 'Data': '(DLC)   12345678'},
+            {'TagNumber': 856, 'Data': 'http://www.example.com/catalog/record/12345678'},
+        ]
+        rows = [samples[i % len(samples)] for i in range(options['rows'])]
+        works = ['{}{}'.format(settings.CONNECTOR['work_prefix'], i) for i in range(options['rows'])]
+        self.report('identifiers', options, lambda: rules.parse_rows(rows))
+        self.report('works', options, lambda: [rules.get_work_id(data) for data in works])
+
+    def report(self, name, options, parse):
+        best = min(timeit.repeat(parse, number=1, repeat=options['repeat']))
+        self.stdout.write('{}: {} rows in {:.3f}s, {:.0f} rows/s'.format(
+            name,
+            options['rows'],
+            best,
+            options['rows'] / best))
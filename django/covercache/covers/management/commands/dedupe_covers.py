@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from covers.models import Cover, CoverBlob
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves cover images stored before content addressing into blobs '
+        'and deletes the files and blobs no cover refers to any more')
+
+    def handle(self, *args, **options):
+        migrated = 0
+        legacy_names = set()
+        for cover in Cover.objects.filter(blob__isnull=True).iterator():
+            legacy_name = cover.image.name
+            try:
+                cover.image.open('rb')
+                blob = CoverBlob.store(cover.image)
+            except (IOError, OSError):
+                self.stderr.write('missing image {} for cover {}'.format(legacy_name, cover.pk))
+                continue
+            finally:
+                cover.image.close()
+            cover.blob = blob
+            cover.image = blob.image.name
+            cover.save(update_fields=['blob', 'image'])
+            migrated += 1
+            if legacy_name != blob.image.name:
+                legacy_names.add(legacy_name)
+
+        reclaimed = 0
+        referenced_names = set(Cover.objects.filter(
+            image__in=legacy_names).values_list('image', flat=True))
+        for name in legacy_names - referenced_names:
+            reclaimed += default_storage.size(name)
+            default_storage.delete(name)
+
+        # leaves recently stored blobs alone, as their covers may still be being saved
+        orphaned_blobs = CoverBlob.objects.filter(
+            covers__isnull=True,
+            date_created__lt=timezone.now() - timedelta(hours=1))
+        for blob in orphaned_blobs:
+            if default_storage.exists(blob.image.name):
+                reclaimed += blob.size
+                default_storage.delete(blob.image.name)
+            blob.delete()
+
+        self.stdout.write('migrated {} covers, reclaimed {} bytes'.format(migrated, reclaimed))
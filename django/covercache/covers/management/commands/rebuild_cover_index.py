@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from covers.models import Work, WorkCoverIndex
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the cover index of every work'
+
+    def handle(self, *args, **options):
+        work_ids = list(Work.objects.values_list('id', flat=True))
+        for i in range(0, len(work_ids), settings.BULK_UPDATE_SIZE):
+            WorkCoverIndex.refresh(work_ids[i:i + settings.BULK_UPDATE_SIZE])
+        self.stdout.write('indexed {} works, {} with covers'.format(
+            len(work_ids),
+            WorkCoverIndex.objects.filter(has_cover=True).count()))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cover',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('source', models.CharField(max_length=32, null=True)),
+                ('image', models.ImageField(upload_to='covers/')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Identifier',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('source', models.CharField(max_length=32)),
+                ('value', models.CharField(max_length=256)),
+                ('date_last_checked', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Manifestation',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('date_last_checked', models.DateTimeField(null=True)),
+                ('precedence', models.IntegerField()),
+                ('identifiers', models.ManyToManyField(related_name='manifestations', to='covers.Identifier')),
+            ],
+            options={
+                'ordering': ['-precedence', '-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Work',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='manifestation',
+            name='work',
+            field=models.ForeignKey(null=True, related_name='manifestations', to='covers.Work'),
+        ),
+        migrations.AddField(
+            model_name='cover',
+            name='identifier',
+            field=models.ForeignKey(related_name='covers', to='covers.Identifier'),
+        ),
+    ]
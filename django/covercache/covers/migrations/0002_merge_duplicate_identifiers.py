@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    merges identifiers sharing a source and value into the oldest of them,
+    so that the next migration can make them unique
+    """
+
+    dependencies = [
+        ('covers', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL([
+            """
+            CREATE TEMPORARY TABLE covers_identifier_duplicate AS
+            SELECT id, keep_id FROM (
+                SELECT id, MIN(id) OVER (PARTITION BY source, value) AS keep_id
+                FROM covers_identifier) identifiers
+            WHERE id <> keep_id""",
+            """
+            UPDATE covers_cover SET identifier_id = duplicate.keep_id
+            FROM covers_identifier_duplicate duplicate
+            WHERE covers_cover.identifier_id = duplicate.id""",
+            """
+            INSERT INTO covers_manifestation_identifiers (manifestation_id, identifier_id)
+            SELECT DISTINCT manifestation_identifier.manifestation_id, duplicate.keep_id
+            FROM covers_manifestation_identifiers manifestation_identifier
+            JOIN covers_identifier_duplicate duplicate ON manifestation_identifier.identifier_id = duplicate.id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM covers_manifestation_identifiers existing
+                WHERE existing.manifestation_id = manifestation_identifier.manifestation_id
+                    AND existing.identifier_id = duplicate.keep_id)""",
+            """
+            DELETE FROM covers_manifestation_identifiers
+            WHERE identifier_id IN (SELECT id FROM covers_identifier_duplicate)""",
+            """
+            DELETE FROM covers_identifier
+            WHERE id IN (SELECT id FROM covers_identifier_duplicate)""",
+            "DROP TABLE covers_identifier_duplicate",
+        ], migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.postgres.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('covers', '0002_merge_duplicate_identifiers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('stage', models.CharField(max_length=64)),
+                ('first_id', models.IntegerField()),
+                ('last_id', models.IntegerField()),
+                ('date_completed', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CoverBlob',
+            fields=[
+                ('hash', models.CharField(primary_key=True, max_length=64, serialize=False)),
+                ('image', models.ImageField(upload_to='covers/')),
+                ('size', models.IntegerField()),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HarvestQueueEntry',
+            fields=[
+                ('demand', models.IntegerField(default=0)),
+                ('newest_manifestation_id', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(null=True)),
+                ('lease_until', models.DateTimeField(null=True)),
+                ('work', models.OneToOneField(primary_key=True, serialize=False, related_name='harvest_queue_entry', to='covers.Work')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MaintenanceRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('full_resync', models.BooleanField(default=False)),
+                ('date_started', models.DateTimeField(auto_now_add=True)),
+                ('date_completed', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Recommendation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('rank', models.IntegerField()),
+            ],
+            options={
+                'ordering': ['rank'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SourceCheck',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('source', models.CharField(max_length=32)),
+                ('outcome', models.CharField(max_length=16, choices=[('hit', 'hit'), ('miss', 'miss'), ('error', 'error')])),
+                ('status_code', models.IntegerField(null=True)),
+                ('misses', models.IntegerField(default=0)),
+                ('date_checked', models.DateTimeField()),
+                ('next_check', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StageCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('stage', models.CharField(max_length=64)),
+                ('chunks', models.IntegerField(null=True)),
+                ('watermark', models.DateTimeField(null=True)),
+                ('date_begun', models.DateTimeField(null=True)),
+                ('date_completed', models.DateTimeField(null=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('run', models.ForeignKey(related_name='checkpoints', to='covers.MaintenanceRun')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Statistic',
+            fields=[
+                ('name', models.CharField(primary_key=True, max_length=128, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('name', models.CharField(primary_key=True, max_length=64, serialize=False)),
+                ('value', models.DateTimeField()),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WorkCoverIndex',
+            fields=[
+                ('work', models.OneToOneField(primary_key=True, serialize=False, related_name='cover_index', to='covers.Work')),
+                ('cover_ids', django.contrib.postgres.fields.ArrayField(default=list, base_field=models.IntegerField(), size=None)),
+                ('has_cover', models.BooleanField(db_index=True, default=False)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cover',
+            name='height',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cover',
+            name='rank',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cover',
+            name='size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cover',
+            name='width',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='work',
+            name='date_recommendations_refreshed',
+            field=models.DateTimeField(null=True, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='identifier',
+            unique_together=set([('source', 'value')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cover',
+            index_together=set([('identifier', 'rank', 'date_created')]),
+        ),
+        migrations.AddField(
+            model_name='sourcecheck',
+            name='identifier',
+            field=models.ForeignKey(related_name='source_checks', to='covers.Identifier'),
+        ),
+        migrations.AddField(
+            model_name='recommendation',
+            name='recommended_work',
+            field=models.ForeignKey(related_name='recommended_by', to='covers.Work'),
+        ),
+        migrations.AddField(
+            model_name='recommendation',
+            name='work',
+            field=models.ForeignKey(related_name='recommendations', to='covers.Work'),
+        ),
+        migrations.AlterIndexTogether(
+            name='harvestqueueentry',
+            index_together=set([('demand', 'newest_manifestation_id')]),
+        ),
+        migrations.AddField(
+            model_name='chunkcheckpoint',
+            name='run',
+            field=models.ForeignKey(related_name='chunk_checkpoints', to='covers.MaintenanceRun'),
+        ),
+        migrations.RemoveField(
+            model_name='identifier',
+            name='date_last_checked',
+        ),
+        migrations.AddField(
+            model_name='cover',
+            name='blob',
+            field=models.ForeignKey(null=True, related_name='covers', to='covers.CoverBlob'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stagecheckpoint',
+            unique_together=set([('run', 'stage')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sourcecheck',
+            unique_together=set([('identifier', 'source')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sourcecheck',
+            index_together=set([('source', 'next_check')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recommendation',
+            unique_together=set([('work', 'recommended_work')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='chunkcheckpoint',
+            index_together=set([('run', 'stage', 'first_id')]),
+        ),
+    ]
@@ -1,24 +1,34 @@
-from celery import group
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import timedelta
-import itertools
-import operator
+from hashlib import sha256
+import functools
+import json
+import os
+import threading
 import time
+import uuid
 
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.images import get_image_dimensions
+from django.core.files.storage import default_storage
 from django.utils import timezone
 
-from . import sources
-from covercache import connector
+from . import imaging, sources, throttle
+from covercache import connector, redisclient
 
 
 class Work(models.Model):
     id = models.IntegerField(primary_key=True)
+    date_recommendations_refreshed = models.DateTimeField(null=True, db_index=True)
 
     def has_cover(self):
-        return bool(Cover.objects.filter(
-            identifier__in=Identifier.objects.filter(
-                manifestations__in=self.manifestations.all())).count())
+        return WorkCoverIndex.objects.filter(work=self, has_cover=True).exists()
 
     def get_identifiers(self):
         sorted_identifiers = []
@@ -29,58 +39,350 @@ class Work(models.Model):
         return sorted_identifiers
 
     def get_covers(self):
-        covers = list(Cover.objects.filter(
-            identifier__in=Identifier.objects.filter(
-                manifestations__in=self.manifestations.all())))
-        covers.sort(key=operator.methodcaller('get_precedence'))
-        return covers
+        return list(Cover.objects.filter(
+            identifier__manifestations__work=self).distinct().order_by(*Cover.PRECEDENCE_ORDERING))
 
-    def try_to_download_cover(self):
+    def try_to_download_cover(self, concurrent=False):
         identifiers = self.get_identifiers()
+        if concurrent:
+            return self._try_to_download_cover_concurrently(identifiers)
+        checks = SourceCheck.get_checks(identifiers)
+        for Source in sources.get_sources():
+            source = Source()
+            for identifier in identifiers:
+                if source.accepts(identifier):
+                    check = checks.get((identifier.id, source.source)) or SourceCheck(
+                        identifier=identifier,
+                        source=source.source)
+                    cover = identifier.try_to_download_cover(source, check)
+                    if cover:
+                        return cover
+
+    def _try_to_download_cover_concurrently(self, identifiers):
+        """
+        probes every applicable source/identifier pair at once,
+        keeping the cover of the highest precedence pair which succeeds
+        """
+        checks = SourceCheck.get_checks(identifiers)
+        candidates = []
         for Source in sources.get_sources():
             source = Source()
             for identifier in identifiers:
-                cover = identifier.try_to_download_cover(source)
-                if cover:
-                    return cover
+                if source.accepts(identifier):
+                    check = checks.get((identifier.id, source.source)) or SourceCheck(
+                        identifier=identifier,
+                        source=source.source)
+                    if check.is_due():
+                        candidates.append((source, identifier, check))
+        if not candidates:
+            return
+        executor = ThreadPoolExecutor(max_workers=settings.PROBE_WORKERS)
+        cancelled = threading.Event()
+        # the whole poll, throttle waits included, has to finish well within the web worker's timeout
+        deadline = time.time() + settings.POLL_TIMEOUT
+        try:
+            futures = [
+                executor.submit(identifier.fetch_cover, source, cancelled, deadline)
+                for source, identifier, check in candidates]
+            #  waiting in precedence order means a pair is only accepted
+            #  once every pair ranked above it has missed
+            for rank, future in enumerate(futures):
+                try:
+                    result = future.result(timeout=max(deadline - time.time(), 0))
+                except FutureTimeoutError:
+                    # out of time, so this request gets no cover, probes which finish anyway are still recorded
+                    self._abandon_probes(futures[rank:], candidates[rank:], cancelled)
+                    return
+                source, identifier, check = candidates[rank]
+                if result.outcome != sources.CANCELLED:
+                    check.record(result)
+                if result.file:
+                    # lower precedence probes stop at their next checkpoint,
+                    # those which finish anyway are still recorded
+                    self._abandon_probes(futures[rank + 1:], candidates[rank + 1:], cancelled)
+                    return identifier.save_cover(source, result.file)
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False)
+
+    def _abandon_probes(self, futures, candidates, cancelled):
+        cancelled.set()
+        caller = threading.current_thread()
+        for future, (_, _, check) in zip(futures, candidates):
+            if not future.cancel():
+                future.add_done_callback(functools.partial(_record_probe, check, caller))
 
     def get_recommendations(self):
+        return Work.objects.filter(
+            recommended_by__work=self).order_by('recommended_by__rank')
+
+    # a hash of each isbn to the JSON list of the ids of its cover-bearing works
+    ISBN_INDEX_KEY = 'isbn_work_lists'
+
+    @classmethod
+    def resolve_isbns(cls, isbns):
+        """
+        returns the ids of the cover-bearing works with any of isbns, in the order the isbns were given,
+        looking them up in the isbn to works index hash in redis before falling back to one query
+        """
+        client = redisclient.get_client()
+        unique_isbns = list(set(isbns))
+        work_ids_by_isbn = {}
+        if unique_isbns:
+            for isbn, work_ids in zip(unique_isbns, client.hmget(cls.ISBN_INDEX_KEY, unique_isbns)):
+                if work_ids is not None:
+                    work_ids_by_isbn[isbn] = json.loads(work_ids.decode())
+        missing_isbns = [isbn for isbn in unique_isbns if isbn not in work_ids_by_isbn]
+        if missing_isbns:
+            found = {isbn: [] for isbn in missing_isbns}
+            rows = Identifier.objects.filter(
+                source='isbn',
+                value__in=missing_isbns,
+                manifestations__work__cover_index__has_cover=True).values_list(
+                    'value', 'manifestations__work').order_by('manifestations__work').distinct()
+            for isbn, work_id in rows:
+                found[isbn].append(work_id)
+            # isbns without a work are indexed too, as an empty list, so they are not looked up again;
+            # the whole index expires together so that works which gained covers are picked up
+            pipeline = client.pipeline()
+            pipeline.hmset(cls.ISBN_INDEX_KEY, {isbn: json.dumps(work_ids) for isbn, work_ids in found.items()})
+            pipeline.ttl(cls.ISBN_INDEX_KEY)
+            ttl = pipeline.execute()[-1]
+            if ttl is None or ttl < 0:
+                client.expire(cls.ISBN_INDEX_KEY, settings.ISBN_INDEX_TIMEOUT)
+            work_ids_by_isbn.update(found)
+        work_ids = []
+        for isbn in isbns:
+            for work_id in work_ids_by_isbn.get(isbn, []):
+                if work_id not in work_ids:
+                    work_ids.append(work_id)
+        return work_ids
+
+    def recommendations_are_stale(self):
+        return not self.date_recommendations_refreshed or (
+            self.date_recommendations_refreshed
+            < timezone.now() - timedelta(seconds=settings.RECOMMENDATIONS_TTL))
+
+    def request_recommendations_refresh(self):
+        """
+        queues a refresh of the recommendations unless one is already queued
+        """
         from . import tasks
+        if redisclient.get_client().set(
+                self.get_recommendations_refresh_lock_key(),
+                1,
+                ex=settings.RECOMMENDATIONS_REFRESH_LOCK_TIMEOUT,
+                nx=True):
+            tasks.refresh_recommendations.delay(self.id)
+
+    def get_recommendations_refresh_lock_key(self):
+        return 'recommendations:refresh:{}'.format(self.id)
+
+    def refresh_recommendations(self):
+        """
+        replaces the stored recommendations, keeping them as they are if zola could not be asked for any identifier
+        """
+        source = sources.get_source(settings.RECOMMENDATIONS['source'])()
         identifiers = Identifier.objects.filter(
             source='isbn',
-            manifestations__in=self.manifestations.all())
-        grouped_identifier_ids = group(
-            tasks.get_recommendations.s(i.pk)
-            for i in identifiers)().get()
-        result_identifier_ids = itertools.chain.from_iterable(grouped_identifier_ids)
-        works = Work.objects.filter(pk__in=result_identifier_ids)
-        return works
+            manifestations__work=self).distinct()
+        isbns = []
+        for identifier in identifiers:
+            identifier_isbns = source.get_recommended_isbns(identifier)
+            if identifier_isbns is None:
+                return
+            isbns.extend(identifier_isbns)
+        recommended_work_ids = [
+            work_id for work_id in Work.resolve_isbns(isbns) if work_id != self.id]
+        with transaction.atomic():
+            self.recommendations.all().delete()
+            Recommendation.objects.bulk_create([
+                Recommendation(work=self, recommended_work_id=work_id, rank=rank)
+                for rank, work_id in enumerate(recommended_work_ids)])
+            self.date_recommendations_refreshed = timezone.now()
+            Work.objects.filter(pk=self.pk).update(
+                date_recommendations_refreshed=self.date_recommendations_refreshed)
+
+
+def _record_probe(check, caller, future):
+    """
+    records the outcome of a probe which finished after a higher precedence probe had already found a cover
+    """
+    try:
+        if future.exception() is None and future.result().outcome != sources.CANCELLED:
+            check.record(future.result())
+    finally:
+        if threading.current_thread() is not caller:
+            # the probe thread's connection would otherwise stay open until the database drops it
+            connection.close()
 
 
 class Identifier(models.Model):
     source = models.CharField(max_length=32)
     value = models.CharField(max_length=256)
-    date_last_checked = models.DateTimeField(null=True)
+
+    @classmethod
+    def get_or_create_many(cls, identifier_attributes):
+        """
+        returns {(source, value): identifier} for every identifier in identifier_attributes,
+        looking them all up in one query and creating the missing ones in bulk
+        """
+        keys = {
+            (identifier_attribute['source'], identifier_attribute['value'])
+            for identifier_attribute in identifier_attributes
+        }
+        identifiers = cls._get_many(keys)
+        missing_keys = keys - set(identifiers)
+        if missing_keys:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(
+                        [cls(source=source, value=value) for source, value in missing_keys],
+                        batch_size=settings.BULK_UPDATE_SIZE)
+            except IntegrityError:
+                # another worker created some of them first
+                for source, value in missing_keys:
+                    cls.objects.get_or_create(source=source, value=value)
+            # bulk_create does not set primary keys, so read the new rows back
+            identifiers.update(cls._get_many(missing_keys))
+        return identifiers
+
+    @classmethod
+    def _get_many(cls, keys):
+        identifiers = {}
+        values = sorted({value for source, value in keys})
+        for i in range(0, len(values), settings.BULK_UPDATE_SIZE):
+            candidates = cls.objects.filter(
+                source__in={source for source, value in keys},
+                value__in=values[i:i + settings.BULK_UPDATE_SIZE])
+            for identifier in candidates:
+                key = (identifier.source, identifier.value)
+                if key in keys:
+                    identifiers[key] = identifier
+        return identifiers
 
     def has_cover(self):
         return bool(self.covers.all())
 
-    def try_to_download_cover(self, source):
-        if not self.date_last_checked or self.date_last_checked < timezone.now() - timedelta(days=settings.RETRY_PERIOD):
-            self.date_last_checked = timezone.now()
-            self.save()
-            identifier = self
-            file = source.get_cover(identifier)
-            if file:
-                cover = Cover(
-                    source=source.source,
-                    identifier=self,
-                )
-                cover.image.save(
-                    name=file.name,
-                    content=file,
-                    save=True)
-                return cover
+    def fetch_cover(self, source, cancelled=None, deadline=None):
+        if cancelled is not None and cancelled.is_set():
+            # not worth waiting for a throttle slot
+            return sources.CoverResult(None, sources.CANCELLED, None)
+        try:
+            with throttle.source_slot(source.source, deadline):
+                return source.fetch_cover(self, cancelled)
+        except throttle.SlotTimeout:
+            # the source was never asked, so there is nothing to record
+            return sources.CoverResult(None, sources.CANCELLED, None)
+
+    def save_cover(self, source, file):
+        blob = CoverBlob.store(file)
+        width, height = get_image_dimensions(file)
+        cover = Cover(
+            source=source.source,
+            identifier=self,
+            blob=blob,
+            image=blob.image.name,
+            width=width,
+            height=height,
+            size=blob.size,
+            rank=Cover.get_rank(source.source),
+        )
+        cover.save()
+        return cover
+
+    def try_to_download_cover(self, source, check=None):
+        if check is None:
+            check = SourceCheck.get_check(self, source.source)
+        if check.is_due():
+            result = self.fetch_cover(source)
+            check.record(result)
+            if result.file:
+                return self.save_cover(source, result.file)
+
+    class Meta:
+        unique_together = (('source', 'value'),)
+
+
+class SourceCheck(models.Model):
+    """
+    the ledger of attempts to get a cover for an identifier from a source
+    """
+    OUTCOMES = (
+        (sources.HIT, 'hit'),
+        (sources.MISS, 'miss'),
+        (sources.ERROR, 'error'),
+    )
+
+    source = models.CharField(max_length=32)
+    outcome = models.CharField(max_length=16, choices=OUTCOMES)
+    status_code = models.IntegerField(null=True)
+    misses = models.IntegerField(default=0)
+    date_checked = models.DateTimeField()
+    next_check = models.DateTimeField()
+
+    identifier = models.ForeignKey(
+        Identifier,
+        related_name='source_checks')
+
+    @classmethod
+    def get_check(cls, identifier, source_name):
+        try:
+            return cls.objects.get(identifier=identifier, source=source_name)
+        except cls.DoesNotExist:
+            return cls(identifier=identifier, source=source_name)
+
+    @classmethod
+    def get_checks(cls, identifiers):
+        return {
+            (check.identifier_id, check.source): check
+            for check in cls.objects.filter(identifier__in=identifiers)
+        }
+
+    @classmethod
+    def get_due_identifiers(cls):
+        """
+        returns the identifiers which at least one source is eligible to be probed for
+        """
+        now = timezone.now()
+        due = models.Q(pk__in=[])
+        for Source in sources.get_sources():
+            due |= models.Q(source__in=Source.identifier_sources) & ~models.Q(
+                pk__in=cls.objects.filter(
+                    source=Source.source,
+                    next_check__gt=now).values('identifier_id'))
+        return Identifier.objects.filter(due)
+
+    def is_due(self):
+        return not self.next_check or self.next_check <= timezone.now()
+
+    def record(self, result):
+        now = timezone.now()
+        if result.outcome == sources.ERROR:
+            retry_period = timedelta(minutes=settings.TRANSIENT_RETRY_PERIOD)
+        elif result.outcome == sources.MISS:
+            self.misses += 1
+            retry_period = min(
+                timedelta(days=settings.RETRY_PERIOD) * 2 ** min(self.misses - 1, 16),
+                timedelta(days=settings.MAX_RETRY_PERIOD))
+        else:
+            self.misses = 0
+            retry_period = timedelta(days=settings.RETRY_PERIOD)
+        self.outcome = result.outcome
+        self.status_code = result.status_code
+        self.date_checked = now
+        self.next_check = now + retry_period
+        try:
+            with transaction.atomic():
+                self.save()
+        except IntegrityError:
+            # another worker probed the same pair first and inserted its row, which this outcome replaces
+            self.pk = SourceCheck.objects.get(identifier_id=self.identifier_id, source=self.source).pk
+            self.save(force_update=True)
+
+    class Meta:
+        unique_together = (('identifier', 'source'),)
+        index_together = [['source', 'next_check']]
 
 
 class Manifestation(models.Model):
@@ -101,42 +403,597 @@ class Manifestation(models.Model):
         return bool(Cover.objects.filter(
             identifier__in=self.identifiers.all()).count())
 
-    def map_identifiers(self):
-        identifiers = list(self.identifiers.filter(source='staff'))
-        identifier_attributes = connector.get_identifiers(self.id)
-        for identifier_attribute in identifier_attributes:
-            try:
-                identifier = Identifier.objects.get(
-                    value=identifier_attribute['value'],
-                    source=identifier_attribute['source'])
-            except Identifier.DoesNotExist:
-                identifier = Identifier(
-                    value=identifier_attribute['value'],
-                    source=identifier_attribute['source'])
-                identifier.save()
-            identifiers.append(identifier)
-        self.identifiers.clear()
-        self.identifiers.add(*identifiers)
-        self.date_last_checked = timezone.now()
-        self.save()
+    def map_identifiers(self, identifier_attributes=None):
+        if identifier_attributes is None:
+            identifier_attributes = connector.get_identifiers(self.id)
+        Manifestation.map_identifiers_batch({self: identifier_attributes})
+
+    @classmethod
+    def map_identifiers_batch(cls, identifier_attributes_by_manifestation):
+        """
+        maps each manifestation to the identifiers in its identifier attributes, keeping its staff identifiers,
+        inserting and deleting only the links that changed
+        """
+        manifestations = {
+            manifestation.id: manifestation
+            for manifestation in identifier_attributes_by_manifestation
+        }
+        identifiers = Identifier.get_or_create_many([
+            identifier_attribute
+            for identifier_attributes in identifier_attributes_by_manifestation.values()
+            for identifier_attribute in identifier_attributes
+        ])
+        wanted = {
+            manifestation.id: {
+                identifiers[(identifier_attribute['source'], identifier_attribute['value'])].id
+                for identifier_attribute in identifier_attributes
+            }
+            for manifestation, identifier_attributes in identifier_attributes_by_manifestation.items()
+        }
+        Link = cls.identifiers.through
+        current = {manifestation_id: {} for manifestation_id in manifestations}
+        links = Link.objects.filter(manifestation_id__in=list(manifestations)).values_list(
+            'id', 'manifestation_id', 'identifier_id', 'identifier__source')
+        for link_id, manifestation_id, identifier_id, source in links:
+            current[manifestation_id][identifier_id] = link_id
+            if source == 'staff':
+                wanted[manifestation_id].add(identifier_id)
+        removed_link_ids = []
+        added_links = []
+        changed_work_ids = set()
+        for manifestation_id, manifestation in manifestations.items():
+            current_identifier_ids = set(current[manifestation_id])
+            removed = current_identifier_ids - wanted[manifestation_id]
+            added = wanted[manifestation_id] - current_identifier_ids
+            removed_link_ids.extend(current[manifestation_id][identifier_id] for identifier_id in removed)
+            added_links.extend(
+                Link(manifestation_id=manifestation_id, identifier_id=identifier_id)
+                for identifier_id in added)
+            if removed or added:
+                changed_work_ids.add(manifestation.work_id)
+        now = timezone.now()
+        with transaction.atomic():
+            if removed_link_ids:
+                Link.objects.filter(id__in=removed_link_ids).delete()
+            Link.objects.bulk_create(added_links, batch_size=settings.BULK_UPDATE_SIZE)
+            cls.objects.filter(id__in=list(manifestations)).update(date_last_checked=now)
+        for manifestation in manifestations.values():
+            manifestation.date_last_checked = now
+        if changed_work_ids:
+            WorkCoverIndex.refresh(changed_work_ids)
 
     class Meta:
         ordering = ['-precedence', '-id']
 
 
+class CoverBlob(models.Model):
+    """
+    an image file named by the sha256 of its content, shared by every cover with that content
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    image = models.ImageField(upload_to='covers/')
+    size = models.IntegerField()
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def get_name(cls, digest):
+        return 'covers/{}/{}.jpg'.format(digest[:2], digest)
+
+    @classmethod
+    def store(cls, file):
+        file.seek(0)
+        content = file.read()
+        digest = sha256(content).hexdigest()
+        try:
+            return cls.objects.get(hash=digest)
+        except cls.DoesNotExist:
+            pass
+        canonical_name = cls.get_name(digest)
+        name = canonical_name
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(content))
+        blob = cls(hash=digest, image=name, size=len(content))
+        try:
+            with transaction.atomic():
+                blob.save(force_insert=True)
+        except IntegrityError:
+            # another worker stored the same content first, storage may have renamed this copy of its file
+            if name != canonical_name:
+                default_storage.delete(name)
+            return cls.objects.get(hash=digest)
+        return blob
+
+
 class Cover(models.Model):
+    PRECEDENCE_ORDERING = ('rank', '-date_created', '-width')
+
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
     source = models.CharField(max_length=32, null=True)
+    # always the name of the blob's image, kept for covers stored before blobs existed
     image = models.ImageField(upload_to='covers/')
+    width = models.IntegerField(null=True)
+    height = models.IntegerField(null=True)
+    size = models.IntegerField(null=True)
+    # position of the source in SOURCE_PRECEDENCE
+    rank = models.IntegerField(default=0)
 
     identifier = models.ForeignKey(
         Identifier,
         related_name='covers')
 
+    blob = models.ForeignKey(
+        CoverBlob,
+        related_name='covers',
+        null=True)
+
+    def get_rendition_name(self, width):
+        """
+        returns the name of the copy of the image scaled down to width, or None until it has been made
+        """
+        if not self.width or width >= self.width:
+            return self.image.name
+        name = self._get_rendition_name(width)
+        if default_storage.exists(name):
+            return name
+
+    def _get_rendition_name(self, width):
+        return 'renditions/{}/{}.jpg'.format(width, self.blob_id or 'cover_{}'.format(self.pk))
+
+    def request_rendition(self, width):
+        """
+        queues the making of the rendition unless it is already queued
+        """
+        from . import tasks
+        if redisclient.get_client().set(
+                'rendition:{}:{}'.format(self.pk, width),
+                1,
+                ex=settings.RENDITION_LOCK_TIMEOUT,
+                nx=True):
+            tasks.make_rendition.delay(self.pk, width)
+
+    def make_rendition(self, width):
+        name = self._get_rendition_name(width)
+        if default_storage.exists(name):
+            return name
+        self.image.open('rb')
+        try:
+            content = imaging.resize(self.image.read(), width, settings.IMAGE_QUALITY)
+        finally:
+            self.image.close()
+        # written under a temporary name and moved into place, so that concurrent makers never leave a second copy
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(temporary_path, 'wb') as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+        return name
+
+    @classmethod
+    def get_rank(cls, source_name):
+        try:
+            return settings.SOURCE_PRECEDENCE.index(source_name)
+        except ValueError:
+            return len(settings.SOURCE_PRECEDENCE)
+
     def get_precedence(self):
         return (
-            settings.SOURCE_PRECEDENCE.index(self.source),
+            self.rank,
             -time.mktime(self.date_created.timetuple()),
-            -self.image.width,
+            -(self.width or 0),
         )
+
+    class Meta:
+        index_together = [['identifier', 'rank', 'date_created']]
+
+
+class WorkCoverIndex(models.Model):
+    """
+    the covers of a work in precedence order, kept up to date whenever they may change
+    """
+    work = models.OneToOneField(
+        Work,
+        primary_key=True,
+        related_name='cover_index')
+    cover_ids = ArrayField(models.IntegerField(), default=list)
+    has_cover = models.BooleanField(default=False, db_index=True)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    def get_covers(self):
+        covers = Cover.objects.in_bulk(self.cover_ids)
+        return [covers[cover_id] for cover_id in self.cover_ids if cover_id in covers]
+
+    @classmethod
+    def get_covers_by_work(cls, indexes):
+        """
+        returns the ordered covers of each of indexes by work id, fetched in one query
+        """
+        covers = Cover.objects.in_bulk([
+            cover_id
+            for index in indexes
+            for cover_id in index.cover_ids])
+        return {
+            index.work_id: [covers[cover_id] for cover_id in index.cover_ids if cover_id in covers]
+            for index in indexes
+        }
+
+    @classmethod
+    def refresh(cls, work_ids):
+        """
+        recomputes the index of every existing work in work_ids, returning the indexes by work id
+        """
+        work_ids = {work_id for work_id in work_ids if work_id is not None}
+        if not work_ids:
+            return {}
+        cover_ids_by_work = {}
+        rows = Cover.objects.filter(
+            identifier__manifestations__work__in=work_ids).order_by(
+                *Cover.PRECEDENCE_ORDERING).values_list(
+                    'identifier__manifestations__work', 'id')
+        for work_id, cover_id in rows:
+            cover_ids = cover_ids_by_work.setdefault(work_id, [])
+            if cover_id not in cover_ids:
+                cover_ids.append(cover_id)
+        existing_work_ids = Work.objects.filter(id__in=work_ids).values_list('id', flat=True)
+        try:
+            with transaction.atomic():
+                # locking in pk order keeps workers refreshing overlapping works from deadlocking
+                indexes = {
+                    index.work_id: index
+                    for index in cls.objects.select_for_update().filter(
+                        work_id__in=work_ids).order_by('pk')}
+                new_indexes = []
+                works_with_covers_change = 0
+                for work_id in existing_work_ids:
+                    cover_ids = cover_ids_by_work.get(work_id, [])
+                    index = indexes.get(work_id)
+                    if index is None:
+                        index = cls(work_id=work_id, cover_ids=cover_ids, has_cover=bool(cover_ids))
+                        new_indexes.append(index)
+                        indexes[work_id] = index
+                        works_with_covers_change += int(index.has_cover)
+                    elif index.cover_ids != cover_ids:
+                        works_with_covers_change += int(bool(cover_ids)) - int(index.has_cover)
+                        index.cover_ids = cover_ids
+                        index.has_cover = bool(cover_ids)
+                        index.save()
+                cls.objects.bulk_create(new_indexes)
+                Statistic.increment('works_with_covers', works_with_covers_change)
+        except IntegrityError:
+            # another worker created one of the new indexes first, so they can now be updated
+            return cls.refresh(work_ids)
+        return indexes
+
+
+class Recommendation(models.Model):
+    rank = models.IntegerField()
+
+    work = models.ForeignKey(
+        Work,
+        related_name='recommendations')
+
+    recommended_work = models.ForeignKey(
+        Work,
+        related_name='recommended_by')
+
+    class Meta:
+        ordering = ['rank']
+        unique_together = (('work', 'recommended_work'),)
+
+
+class Statistic(models.Model):
+    """
+    a snapshot of the catalog statistics, refreshed nightly and kept current as covers are written
+    """
+    name = models.CharField(max_length=128, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    GROUPED = ('identifiers_by_source', 'worthless_identifiers_by_source', 'covers_by_source')
+
+    @classmethod
+    def get_name(cls, group, key):
+        return '{}:{}'.format(group, key)
+
+    @classmethod
+    def increment(cls, name, amount=1):
+        if amount:
+            cls.objects.filter(name=name).update(
+                value=models.F('value') + amount,
+                date_modified=timezone.now())
+
+    @classmethod
+    def replace_all(cls, values):
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([
+                cls(name=name, value=value)
+                for name, value in values.items()])
+
+    @classmethod
+    def get_snapshot(cls):
+        """
+        returns the statistics nested by group, along with when they were last changed
+        """
+        snapshot = OrderedDict()
+        as_of = None
+        for statistic in cls.objects.order_by('name'):
+            if not as_of or statistic.date_modified > as_of:
+                as_of = statistic.date_modified
+            group, _, key = statistic.name.partition(':')
+            if key:
+                snapshot.setdefault(group, OrderedDict())[key] = statistic.value
+            else:
+                snapshot[group] = statistic.value
+        return snapshot, as_of
+
+
+class SyncWatermark(models.Model):
+    MANIFESTATIONS = 'manifestations'
+    ALTERED_MANIFESTATION_IDS = 'altered_manifestation_ids'
+
+    name = models.CharField(max_length=64, primary_key=True)
+    value = models.DateTimeField()
+    date_modified = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_value(cls, name):
+        try:
+            return cls.objects.get(name=name).value
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def set_value(cls, name, value):
+        cls.objects.update_or_create(name=name, defaults={'value': value})
+
+
+class HarvestQueueEntry(models.Model):
+    """
+    a coverless work waiting to be harvested, ranked by how often it has been asked for since its last attempt
+    and then by how new its newest manifestation is, and held back until one of its sources is due again
+    """
+    demand = models.IntegerField(default=0)
+    newest_manifestation_id = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True)
+    lease_until = models.DateTimeField(null=True)
+
+    work = models.OneToOneField(
+        Work,
+        primary_key=True,
+        related_name='harvest_queue_entry')
+
+    @classmethod
+    def refill(cls):
+        """
+        queues the coverless works with identifiers due to be probed, dropping works which have gained a cover,
+        and returns the number of works now eligible to be harvested
+        """
+        cls.objects.filter(work__cover_index__has_cover=True).delete()
+        candidates = Work.objects.exclude(
+            cover_index__has_cover=True).exclude(
+            harvest_queue_entry__isnull=False).filter(
+            id__in=Manifestation.objects.filter(
+                identifiers__in=SourceCheck.get_due_identifiers()).values('work_id')).annotate(
+            newest_manifestation_id=models.Max('manifestations__id')).values_list(
+                'id', 'newest_manifestation_id')
+        cls.objects.bulk_create(
+            [cls(work_id=work_id, newest_manifestation_id=newest_manifestation_id)
+             for work_id, newest_manifestation_id in candidates],
+            batch_size=settings.BULK_UPDATE_SIZE)
+        # works already queued which have gained a manifestation since move up with it
+        query = """
+            UPDATE {table} SET newest_manifestation_id = newest.id
+            FROM (
+                SELECT work_id, MAX(id) AS id FROM {manifestation_table}
+                WHERE work_id IS NOT NULL
+                GROUP BY work_id
+            ) AS newest
+            WHERE {table}.work_id = newest.work_id
+                AND {table}.newest_manifestation_id <> newest.id""".format(
+            table=cls._meta.db_table,
+            manifestation_table=Manifestation._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+        return cls.get_eligible().count()
+
+    @classmethod
+    def get_eligible(cls):
+        now = timezone.now()
+        return cls.objects.filter(
+            models.Q(next_attempt__isnull=True) | models.Q(next_attempt__lte=now),
+            models.Q(lease_until__isnull=True) | models.Q(lease_until__lt=now))
+
+    @classmethod
+    def dequeue(cls, size):
+        """
+        leases and returns the ids of up to size of the highest ranked eligible works,
+        skipping entries another worker is dequeuing at the same time
+        """
+        now = timezone.now()
+        table = cls._meta.db_table
+        # django 1.8 has no select_for_update(skip_locked=True)
+        query = """
+            UPDATE {table} SET lease_until = %s
+            WHERE work_id IN (
+                SELECT work_id FROM {table}
+                WHERE (next_attempt IS NULL OR next_attempt <= %s)
+                    AND (lease_until IS NULL OR lease_until < %s)
+                ORDER BY demand DESC, newest_manifestation_id DESC
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED)
+            RETURNING work_id, demand, newest_manifestation_id""".format(table=table)
+        lease_until = now + timedelta(seconds=settings.HARVEST_LEASE_TIMEOUT)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(query, [lease_until, now, now, size])
+            rows = cursor.fetchall()
+        rows.sort(key=lambda row: (row[1], row[2]), reverse=True)
+        return [work_id for work_id, demand, newest_manifestation_id in rows]
+
+    @classmethod
+    def release(cls, work_ids):
+        """
+        drops the works which got a cover and holds the rest back until one of their sources is due again
+        """
+        cls.objects.filter(work_id__in=work_ids, work__cover_index__has_cover=True).delete()
+        next_checks = dict(SourceCheck.objects.filter(
+            identifier__manifestations__work__in=work_ids).values_list(
+                'identifier__manifestations__work').annotate(models.Min('next_check')))
+        cls.objects.filter(work_id__in=work_ids).update(
+            demand=0,
+            next_attempt=models.Case(
+                *[models.When(work_id=work_id, then=models.Value(next_check))
+                  for work_id, next_check in next_checks.items()],
+                default=models.Value(None),
+                output_field=models.DateTimeField()),
+            lease_until=None)
+
+    @classmethod
+    def increment_demand(cls, work_id):
+        cls.objects.filter(work_id=work_id).update(demand=models.F('demand') + 1)
+
+    class Meta:
+        index_together = [['demand', 'newest_manifestation_id']]
+
+
+class MaintenanceRun(models.Model):
+    """
+    one run of the maintain pipeline, which checkpoints each of its stages and chunks so that a failed run can resume
+    """
+    STAGES = (
+        'update_altered_manifestation_ids',
+        'prune_manifestations',
+        'update_identifiers',
+        'update_works',
+        'harvest_covers',
+        # after the harvest, so that the stats count the covers it found
+        'refresh_stats',
+    )
+
+    full_resync = models.BooleanField(default=False)
+    date_started = models.DateTimeField(auto_now_add=True)
+    date_completed = models.DateTimeField(null=True)
+
+    @classmethod
+    def start(cls, full_resync=False):
+        """
+        returns the latest unfinished run to resume, or a new run if there is none or it has gone stale,
+        or None while a stage of the latest run is still running
+        """
+        now = timezone.now()
+        run = cls.objects.filter(
+            date_completed__isnull=True,
+            full_resync=full_resync).order_by('-date_started').first()
+        if run is None or run.date_started < now - timedelta(seconds=settings.MAINTENANCE_RUN_MAX_AGE):
+            return cls.objects.create(full_resync=full_resync)
+        if run.checkpoints.filter(
+                date_completed__isnull=True,
+                date_begun__gt=now - timedelta(seconds=settings.MAINTENANCE_STAGE_TIMEOUT)).exists():
+            return None
+        return run
+
+    def get_checkpoint(self, stage):
+        checkpoint, _ = self.checkpoints.get_or_create(stage=stage)
+        return checkpoint
+
+    def get_next_stage(self):
+        completed = set(self.checkpoints.filter(
+            date_completed__isnull=False).values_list('stage', flat=True))
+        for stage in self.STAGES:
+            if stage not in completed:
+                return stage
+
+    def begin(self, stage):
+        checkpoint = self.get_checkpoint(stage)
+        checkpoint.date_begun = timezone.now()
+        checkpoint.save()
+
+    def abandon(self, stage):
+        """
+        marks a failed stage as no longer running, so that the next maintain resumes it
+        """
+        self.checkpoints.filter(stage=stage).update(date_begun=None)
+
+    def complete(self, stage):
+        """
+        completes stage, returning whether this call was the one which completed it
+        """
+        checkpoint = self.get_checkpoint(stage)
+        completed = StageCheckpoint.objects.filter(
+            pk=checkpoint.pk,
+            date_completed__isnull=True).update(date_completed=timezone.now())
+        if completed and stage == self.STAGES[-1]:
+            self.date_completed = timezone.now()
+            self.save()
+        return bool(completed)
+
+    def reset_chunks(self, stage):
+        self.chunk_checkpoints.filter(stage=stage).delete()
+        self.checkpoints.filter(stage=stage).update(chunks=None, watermark=None)
+
+    def set_chunks(self, stage, chunks, watermark):
+        """
+        records how many chunks a fanned out stage queued, and the watermark to move to once they have all finished
+        """
+        self.checkpoints.filter(stage=stage).update(chunks=chunks, watermark=watermark)
+
+    def count_completed_chunks(self, stage):
+        return self.chunk_checkpoints.filter(stage=stage).count()
+
+    def complete_chunk(self, stage, first_id, last_id):
+        self.chunk_checkpoints.create(stage=stage, first_id=first_id, last_id=last_id)
+
+
+class StageCheckpoint(models.Model):
+    """
+    the progress of a stage of a maintenance run;
+    a stage fanned out in chunks records how many it queued and the watermark to move to once they have finished
+    """
+    stage = models.CharField(max_length=64)
+    chunks = models.IntegerField(null=True)
+    watermark = models.DateTimeField(null=True)
+    date_begun = models.DateTimeField(null=True)
+    date_completed = models.DateTimeField(null=True)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    run = models.ForeignKey(
+        MaintenanceRun,
+        related_name='checkpoints')
+
+    class Meta:
+        unique_together = (('run', 'stage'),)
+
+
+class ChunkCheckpoint(models.Model):
+    """
+    a finished chunk of a stage of a maintenance run, covering the manifestation ids from first_id to last_id
+    """
+    stage = models.CharField(max_length=64)
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+    date_completed = models.DateTimeField(auto_now_add=True)
+
+    run = models.ForeignKey(
+        MaintenanceRun,
+        related_name='chunk_checkpoints')
+
+    class Meta:
+        index_together = [['run', 'stage', 'first_id']]
+
+
+@receiver(post_save, sender=Cover)
+def refresh_cover_index_on_save(sender, instance, created, **kwargs):
+    if created:
+        WorkCoverIndex.refresh(Manifestation.objects.filter(
+            identifiers=instance.identifier_id).values_list('work_id', flat=True))
+        Statistic.increment('covers')
+        Statistic.increment(Statistic.get_name('covers_by_source', instance.source))
+
+
+@receiver(post_delete, sender=Cover)
+def refresh_cover_index_on_delete(sender, instance, **kwargs):
+    WorkCoverIndex.refresh(Manifestation.objects.filter(
+        identifiers=instance.identifier_id).values_list('work_id', flat=True))
+    Statistic.increment('covers', -1)
+    Statistic.increment(Statistic.get_name('covers_by_source', instance.source), -1)
@@ -5,14 +5,10 @@ from .models import Work, Cover
 
 class CoverSerializer(serializers.ModelSerializer):
     url = serializers.SerializerMethodField()
-    width = serializers.SerializerMethodField()
 
     def get_url(self, obj):
         return obj.image.url
 
-    def get_width(self, obj):
-        return obj.image.width
-
     class Meta:
         model = Cover
         fields = [
@@ -25,6 +21,10 @@ class WorkSerializer(serializers.ModelSerializer):
     covers = serializers.SerializerMethodField()
 
     def get_covers(self, obj):
+        # covers prefetched for every work being serialized, see WorkCoverIndex.get_covers_by_work
+        covers_by_work = self.context.get('covers_by_work')
+        if covers_by_work is not None:
+            return CoverSerializer(covers_by_work.get(obj.id, []), many=True).data
         return CoverSerializer(obj.get_covers(), many=True).data
 
     class Meta:
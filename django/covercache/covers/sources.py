@@ -1,6 +1,6 @@
-from PIL import Image
 import requests
 
+from collections import namedtuple
 from hashlib import sha256
 import re
 import time
@@ -10,7 +10,25 @@ import hashlib
 from django.core.files import File
 from django.conf import settings
 
+from covercache import httpclient
 from covercache.overdrive import OverdriveAPI
+from . import imaging
+
+
+HIT = 'hit'
+MISS = 'miss'
+ERROR = 'error'
+CANCELLED = 'cancelled'
+
+# outcome of probing a source for one identifier, error being reserved for transient failures
+# and cancelled for probes abandoned because a higher precedence probe already found a cover
+CoverResult = namedtuple('CoverResult', ['file', 'outcome', 'status_code'])
+
+
+class SourceUnavailable(Exception):
+    """
+    raised by get_image_url when the source could not be asked, as opposed to having no cover
+    """
 
 
 def get_sources():
@@ -46,34 +64,115 @@ def get_source(source_name):
 
 class ImageSource(object):
 
+    identifier_sources = ()
+
+    def accepts(self, identifier):
+        return identifier.source in self.identifier_sources
+
     def get_cover(self, identifier):
-        image_url = self.get_image_url(identifier)
+        return self.fetch_cover(identifier).file
+
+    def fetch_cover(self, identifier, cancelled=None):
+        """
+        probes the source for identifier, giving up as soon as the cancelled event is set
+        """
+        try:
+            image_url = self.get_image_url(identifier)
+        except SourceUnavailable:
+            return CoverResult(None, ERROR, None)
         if image_url:
+            if cancelled is not None and cancelled.is_set():
+                return CoverResult(None, CANCELLED, None)
             try:
-                response = requests.get(image_url)
+                response = httpclient.get(image_url, source=self.source, stream=True)
             except requests.exceptions.RequestException:
-                return
-            if self.validate_image_url_response(response):
-                input_bytes = BytesIO(response.content)
-                try:
-                    image = Image.open(input_bytes)
-                except OSError:
-                    # in case sources return files that are not images
-                    return
-                if image.width >= settings.IMAGE_WIDTH:
-                    size = (
-                        settings.IMAGE_WIDTH,
-                        int(settings.IMAGE_WIDTH * image.height / image.width))
-                    image = image.resize(size, Image.ANTIALIAS)
-                    output_bytes = BytesIO()
-                    image.save(output_bytes, 'JPEG')
-                    filename = self.get_filename(identifier)
-                    f = File(output_bytes, filename)
-                    print('{} provided {}'.format(
-                        self.source,
-                        filename
-                    ))
-                    return f
+                return CoverResult(None, ERROR, None)
+            try:
+                if response.status_code == 429 or response.status_code >= 500:
+                    return CoverResult(None, ERROR, response.status_code)
+                # most probes are misses, so the body is only downloaded once the headers look right
+                if self.validate_image_url_headers(response) and self._validate_content_length(response):
+                    try:
+                        content, digest = self._read_content(response, cancelled)
+                    except requests.exceptions.RequestException:
+                        return CoverResult(None, ERROR, response.status_code)
+                    if cancelled is not None and cancelled.is_set():
+                        return CoverResult(None, CANCELLED, response.status_code)
+                    if content and self.validate_image_digest(digest):
+                        try:
+                            processed = imaging.process(content)
+                        except imaging.ProcessingTimeout:
+                            return CoverResult(None, ERROR, response.status_code)
+                        if processed:
+                            filename = self.get_filename(identifier)
+                            f = File(BytesIO(processed['content']), filename)
+                            print('{} provided {} (decoded in {:.3f}s, encoded in {:.3f}s)'.format(
+                                self.source,
+                                filename,
+                                processed['decode_time'],
+                                processed['encode_time'],
+                            ))
+                            return CoverResult(f, HIT, response.status_code)
+                return CoverResult(None, MISS, response.status_code)
+            finally:
+                self._release(response)
+        return CoverResult(None, MISS, None)
+
+    def validate_image_url_headers(self, response):
+        return (
+            response.status_code == 200
+            and not response.headers.get('content-type', '').startswith('text/'))
+
+    def validate_image_digest(self, digest):
+        return True
+
+    def _validate_content_length(self, response):
+        content_length = response.headers.get('content-length')
+        try:
+            return not content_length or int(content_length) <= settings.IMAGE_MAX_BYTES
+        except ValueError:
+            # a malformed header is treated as absent, the size is still capped while reading
+            return True
+
+    def _read_content(self, response, cancelled=None):
+        """
+        returns the body and its sha256 hex digest,
+        or (None, None) once the body exceeds IMAGE_MAX_BYTES or the cancelled event is set
+        """
+        hashed = sha256()
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
+            if cancelled is not None and cancelled.is_set():
+                return None, None
+            size += len(chunk)
+            if size > settings.IMAGE_MAX_BYTES:
+                return None, None
+            hashed.update(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks), hashed.hexdigest()
+
+    def _release(self, response):
+        """
+        returns the connection to the pool, reading what is left of a small or unsized body first,
+        and closes it instead once more than DOWNLOAD_DRAIN_MAX_BYTES is left
+        """
+        content_length = response.headers.get('content-length')
+        try:
+            small = not content_length or int(content_length) <= settings.DOWNLOAD_DRAIN_MAX_BYTES
+        except ValueError:
+            small = True
+        if small and not response._content_consumed:
+            drained = 0
+            try:
+                for chunk in response.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
+                    drained += len(chunk)
+                    if drained > settings.DOWNLOAD_DRAIN_MAX_BYTES:
+                        break
+            except requests.exceptions.RequestException:
+                pass
+        # a fully read body only releases the connection, anything else closes it
+        response.close()
 
     def get_filename(self, identifier):
         return '{}_{}_{}.jpg'.format(
@@ -86,6 +185,7 @@ class ImageSource(object):
 class Amazon(ImageSource):
 
     source = 'amazon'
+    identifier_sources = ('isbn',)
 
     def get_image_url(self, identifier):
         url = None
@@ -95,9 +195,6 @@ class Amazon(ImageSource):
                 isbn=isbn10)
         return url
 
-    def validate_image_url_response(self, response):
-        return response.status_code == 200
-
     def _isbn_convert_13_to_10(self, isbn):
         prefix = isbn[3:-1]
         check = self._isbn10_check_digit(prefix)
@@ -120,6 +217,7 @@ class Amazon(ImageSource):
 class Bibliotheca(ImageSource):
 
     source = 'bibliotheca'
+    identifier_sources = ('bibliotheca',)
 
     def get_image_url(self, identifier):
         url = None
@@ -128,13 +226,11 @@ class Bibliotheca(ImageSource):
                 bibliotheca_id=identifier.value)
         return url
 
-    def validate_image_url_response(self, response):
-        return response.status_code == 200
-
 
 class Link(ImageSource):
 
     source = 'link'
+    identifier_sources = ('link',)
 
     def get_image_url(self, identifier):
         url = None
@@ -142,9 +238,6 @@ class Link(ImageSource):
             url = identifier.value
         return url
 
-    def validate_image_url_response(self, response):
-        return response.status_code == 200
-
     def get_filename(self, identifier):
         return '{}_{}.jpg'.format(
             identifier.source,
@@ -155,12 +248,19 @@ class Link(ImageSource):
 class Overdrive(ImageSource):
 
     source = 'overdrive'
+    identifier_sources = ('overdrive',)
 
     def get_image_url(self, identifier):
         url = None
         if identifier.source == 'overdrive':
             o = OverdriveAPI()
-            res = o.get_metadata(identifier.value)
+            try:
+                res = o.get_metadata(identifier.value)
+            except requests.exceptions.RequestException:
+                raise SourceUnavailable()
+            # no response means no token could be had
+            if res is None or res.status_code in (401, 429) or res.status_code >= 500:
+                raise SourceUnavailable()
             if res.status_code == 200:
                 try:
                     url = res.json()['images']['cover']['href']
@@ -168,13 +268,11 @@ class Overdrive(ImageSource):
                     pass
         return url
 
-    def validate_image_url_response(self, response):
-        return response.status_code == 200
-
 
 class Staff(ImageSource):
 
     source = 'staff'
+    identifier_sources = ('staff',)
 
     def get_image_url(self, identifier):
         url = None
@@ -182,9 +280,6 @@ class Staff(ImageSource):
             url = identifier.value
         return url
 
-    def validate_image_url_response(self, response):
-        return response.status_code == 200
-
     def get_filename(self, identifier):
         return '{}_{}.jpg'.format(
             identifier.source,
@@ -195,6 +290,7 @@ class Staff(ImageSource):
 class Syndetics(ImageSource):
 
     source = 'syndetics'
+    identifier_sources = ('isbn',)
     client_id = settings.SYNDETICS['client_id']
 
     def get_image_url(self, identifier):
@@ -205,24 +301,27 @@ class Syndetics(ImageSource):
                 client_id=self.client_id)
         return url
 
-    def validate_image_url_response(self, response):
-        return response.headers['content-type'].startswith('image')
+    def validate_image_url_headers(self, response):
+        return response.headers.get('content-type', '').startswith('image')
 
 
 class Worldcat(ImageSource):
 
     source = 'worldcat'
+    identifier_sources = ('oclc',)
     default_image_hash = settings.WORLDCAT['default_image_hash']
 
     def get_image_url(self, identifier):
         url = None
         if identifier.source == 'oclc':
             try:
-                res = requests.get('http://www.worldcat.org/oclc/{oclc}'.format(
+                res = httpclient.get('http://www.worldcat.org/oclc/{oclc}'.format(
                     oclc=identifier.value
-                ))
+                ), source=self.source)
             except requests.exceptions.RequestException:
-                return
+                raise SourceUnavailable()
+            if res.status_code == 429 or res.status_code >= 500:
+                raise SourceUnavailable()
             exp = r'coverart\.oclc\.org/ImageWebSvc/oclc/\+-\+(\d+)_140\.jpg'
             if res.status_code == 200:
                 m = re.search(exp, res.content.decode(res.encoding))
@@ -232,13 +331,14 @@ class Worldcat(ImageSource):
                         image_id=image_id)
         return url
 
-    def validate_image_url_response(self, response):
-        return sha256(response.content).hexdigest() != self.default_image_hash
+    def validate_image_digest(self, digest):
+        return digest != self.default_image_hash
 
 
 class Zola(ImageSource):
 
     source = 'zola'
+    identifier_sources = ('isbn',)
     key = settings.ZOLA['key']
     secret = settings.ZOLA['secret']
     default_image_hash = settings.ZOLA['default_image_hash']
@@ -252,7 +352,14 @@ class Zola(ImageSource):
         return signature
 
     def get_recommendations(self, identifier):
-        from .models import Identifier, Work
+        from .models import Work
+        isbns = self.get_recommended_isbns(identifier)
+        return Work.resolve_isbns(isbns or [])
+
+    def get_recommended_isbns(self, identifier):
+        """
+        returns the isbns recommended for identifier, or None if zola could not be asked
+        """
         isbns = []
         if identifier.source == 'isbn':
             url = 'https://api.zo.la/v4/recommendation/rec?action=get&isbn={isbn}&key={key}&signature={signature}&limit={limit}'.format(
@@ -260,21 +367,18 @@ class Zola(ImageSource):
                 key=self.key,
                 signature=self.get_signature(),
                 limit=settings.RECOMMENDATIONS['recommendations_per_identifier'])
-            raw_res = requests.get(url)
-            if raw_res.status_code == 200:
+            try:
+                raw_res = httpclient.get(url, source=self.source)
+                if raw_res.status_code != 200:
+                    return None
                 res = raw_res.json()
-                if res['status'] == 'success' and res.get('data'):
-                    for item in res['data'].get('list', []):
-                        for isbn in item.get('version_isbns', []):
-                            isbns.append(isbn)
-        recommended_work_ids = list(Work.objects.filter(
-            manifestations__identifiers__covers__isnull=False,
-            manifestations__identifiers__in=Identifier.objects.filter(
-                source='isbn',
-                value__in=isbns)).values_list(
-                    'pk',
-                    flat=True))
-        return recommended_work_ids
+            except (requests.exceptions.RequestException, ValueError):
+                return None
+            if res['status'] == 'success' and res.get('data'):
+                for item in res['data'].get('list', []):
+                    for isbn in item.get('version_isbns', []):
+                        isbns.append(isbn)
+        return isbns
 
     def get_additional_information(self, identifier):
         if identifier.source == 'isbn':
@@ -282,7 +386,10 @@ class Zola(ImageSource):
                 isbn=identifier.value,
                 key=self.key,
                 signature=self.get_signature())
-            raw_res = requests.get(url)
+            try:
+                raw_res = httpclient.get(url, source=self.source)
+            except requests.exceptions.RequestException:
+                return
             if raw_res.status_code == 200:
                 res = raw_res.json()
                 if res['status'] == 'success':
@@ -295,5 +402,5 @@ class Zola(ImageSource):
                 isbn=identifier.value)
         return url
 
-    def validate_image_url_response(self, response):
-        return sha256(response.content).hexdigest() != self.default_image_hash
+    def validate_image_digest(self, digest):
+        return digest != self.default_image_hash
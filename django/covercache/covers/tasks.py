@@ -1,26 +1,223 @@
-from celery import shared_task
+from celery import chord, shared_task
+import dateutil.parser
+
+from datetime import timedelta
 
 from django.conf import settings
+from django.utils import timezone
+
+from covercache import redisclient
 
 from . import utils
-from .models import Identifier
-from .sources import get_source
+from .models import Cover, HarvestQueueEntry, MaintenanceRun, Work
+
+
+@shared_task
+def maintain(full_resync=False):
+    """
+    resumes the latest unfinished maintenance run from its first incomplete stage, or starts a new run,
+    unless a stage of the latest run is still running
+    """
+    run = MaintenanceRun.start(full_resync)
+    if run is None:
+        print('maintenance is already running')
+        return
+    _continue(run)
+
+
+def _continue(run):
+    """
+    queues the next incomplete stage of run, each stage queueing the one after it once it has completed
+    """
+    stages = {
+        'update_altered_manifestation_ids': update_altered_manifestation_ids,
+        'prune_manifestations': prune_manifestations,
+        'update_identifiers': update_identifiers,
+        'update_works': update_works,
+        'harvest_covers': harvest_covers,
+        'refresh_stats': refresh_stats,
+    }
+    stage = run.get_next_stage()
+    if stage:
+        stages[stage].delay(run.id)
+
+
+def _run_stage(run_id, stage, function, *args):
+    run = MaintenanceRun.objects.get(pk=run_id)
+    run.begin(stage)
+    try:
+        function(*args)
+    except Exception:
+        run.abandon(stage)
+        raise
+    run.complete(stage)
+    _continue(run)
+
+
+@shared_task
+def update_altered_manifestation_ids(run_id):
+    run = MaintenanceRun.objects.get(pk=run_id)
+    _run_stage(run_id, 'update_altered_manifestation_ids', utils.update_altered_manifestation_ids, run.full_resync)
+
+
+@shared_task
+def prune_manifestations(run_id):
+    _run_stage(run_id, 'prune_manifestations', utils.prune_manifestations)
+
+
+@shared_task
+def update_identifiers(run_id):
+    """
+    fans the manifestations modified since the last sync out across the workers,
+    queueing each chunk as soon as it has streamed in;
+    a resumed stage queues every chunk again, its manifestations checked since they were last modified are skipped
+    """
+    stage = 'update_identifiers'
+    run = MaintenanceRun.objects.get(pk=run_id)
+    run.begin(stage)
+    run.reset_chunks(stage)
+    chunks = 0
+    latest = None
+    try:
+        for chunk, latest in utils.get_identifier_chunks(run.full_resync):
+            update_identifiers_chunk.delay(run_id, [
+                [manifestation_attributes['manifestation_id'],
+                 manifestation_attributes['date_updated'].isoformat(),
+                 manifestation_attributes['precedence']]
+                for manifestation_attributes in chunk
+            ])
+            chunks += 1
+    except Exception:
+        run.abandon(stage)
+        raise
+    run.set_chunks(stage, chunks, latest)
+    _finish_update_identifiers(run)
+
+
+@shared_task
+def update_identifiers_chunk(run_id, chunk):
+    stage = 'update_identifiers'
+    run = MaintenanceRun.objects.get(pk=run_id)
+    try:
+        utils.update_identifiers_chunk([
+            {
+                'manifestation_id': manifestation_id,
+                'date_updated': dateutil.parser.parse(date_updated),
+                'precedence': precedence,
+            }
+            for manifestation_id, date_updated, precedence in chunk
+        ])
+    except Exception:
+        run.abandon(stage)
+        raise
+    run.complete_chunk(stage, chunk[0][0], chunk[-1][0])
+    _finish_update_identifiers(run)
+
+
+def _finish_update_identifiers(run):
+    """
+    moves the watermark and completes the stage once every queued chunk has finished,
+    whichever of the stage and its chunks gets there last
+    """
+    stage = 'update_identifiers'
+    checkpoint = run.get_checkpoint(stage)
+    if checkpoint.chunks is None or run.count_completed_chunks(stage) < checkpoint.chunks:
+        return
+    utils.finish_update_identifiers(checkpoint.watermark)
+    if run.complete(stage):
+        _continue(run)
+
+
+@shared_task
+def update_works(run_id):
+    _run_stage(run_id, 'update_works', utils.update_works)
+
+
+@shared_task
+def harvest_covers(run_id=None):
+    """
+    refills the harvest queue and fans it out across the workers, each chunk taking the next highest ranked batch,
+    reporting the covers found per source once every chunk has finished;
+    works attempted by an earlier attempt are held back until due again, so a resumed harvest skips them
+    """
+    if run_id is not None:
+        MaintenanceRun.objects.get(pk=run_id).begin('harvest_covers')
+    eligible = HarvestQueueEntry.refill()
+    chunk_size = settings.HARVEST_CHUNK_SIZE
+    chunks = (eligible + chunk_size - 1) // chunk_size
+    if chunks:
+        # a failed chunk still ends the run, the works it missed are harvested by the next one
+        report = report_harvest.s(run_id).on_error(finish_harvest.si(run_id))
+        chord(try_to_download_covers.s() for _ in range(chunks))(report)
+    else:
+        finish_harvest(run_id)
+
+
+@shared_task
+def try_to_download_covers(work_ids=None):
+    return utils.try_to_download_covers(work_ids)
+
+
+@shared_task
+def report_harvest(results, run_id=None):
+    covers_by_source = {}
+    for result in results:
+        for source, count in result.items():
+            covers_by_source[source] = covers_by_source.get(source, 0) + count
+    for source in settings.SOURCE_PRECEDENCE:
+        print('{} provided {} covers'.format(source, covers_by_source.get(source, 0)))
+    finish_harvest(run_id)
+    return covers_by_source
+
+
+@shared_task
+def finish_harvest(run_id=None):
+    """
+    completes the harvest, refreshing the stats once it is over so that they count the covers it found
+    """
+    if run_id is None:
+        utils.refresh_stats()
+        return
+    run = MaintenanceRun.objects.get(pk=run_id)
+    if run.complete('harvest_covers'):
+        _continue(run)
+
+
+@shared_task
+def refresh_stats(run_id):
+    _run_stage(run_id, 'refresh_stats', utils.refresh_stats)
+
+
+@shared_task
+def refresh_recommendations(work_id):
+    try:
+        work = Work.objects.get(pk=work_id)
+    except Work.DoesNotExist:
+        return
+    try:
+        work.refresh_recommendations()
+    finally:
+        redisclient.get_client().delete(work.get_recommendations_refresh_lock_key())
 
 
 @shared_task
-def maintain():
-    utils.update_altered_manifestation_ids()
-    utils.prune_manifestations()
-    utils.update_identifiers()
-    utils.update_works()
-    utils.try_to_download_covers()
+def refresh_stale_recommendations():
+    """
+    refreshes the stale recommendations of works which have been asked for them before
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.RECOMMENDATIONS_TTL)
+    work_ids = Work.objects.filter(
+        date_recommendations_refreshed__lt=cutoff).order_by(
+            'date_recommendations_refreshed').values_list(
+                'id', flat=True)[:settings.RECOMMENDATIONS_REFRESH_BATCH_SIZE]
+    for work in Work.objects.filter(id__in=list(work_ids)):
+        work.request_recommendations_refresh()
 
 
 @shared_task
-def get_recommendations(identifier_id):
+def make_rendition(cover_id, width):
     try:
-        identifier = Identifier.objects.get(pk=identifier_id)
-    except Identifier.DoesNotExist:
-        return []
-    source = get_source(settings.RECOMMENDATIONS['source'])()
-    return source.get_recommendations(identifier)
+        cover = Cover.objects.get(pk=cover_id)
+    except Cover.DoesNotExist:
+        return
+    cover.make_rendition(width)
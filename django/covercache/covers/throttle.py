@@ -0,0 +1,74 @@
+from contextlib import contextmanager
+import time
+import uuid
+
+from django.conf import settings
+
+from covercache import redisclient
+
+
+class SlotTimeout(Exception):
+    pass
+
+
+@contextmanager
+def source_slot(source_name, deadline=None):
+    """
+    blocks until source_name is below both its concurrency cap and its request rate,
+    counted across every worker on every node sharing the redis instance,
+    raising SlotTimeout if that has not happened by the time.time() deadline
+    """
+    limits = settings.SOURCE_LIMITS.get(source_name, {})
+    client = redisclient.get_client()
+    token = None
+    if limits.get('concurrency'):
+        token = _acquire_concurrency(client, source_name, limits['concurrency'], deadline)
+    try:
+        if limits.get('requests'):
+            _wait_for_rate(client, source_name, limits['requests'], limits.get('period', 1), deadline)
+        yield
+    finally:
+        if token:
+            client.zrem(_concurrency_key(source_name), token)
+
+
+def _concurrency_key(source_name):
+    return 'covers:throttle:{}:concurrency'.format(source_name)
+
+
+def _acquire_concurrency(client, source_name, concurrency, deadline=None):
+    #  slots are members of a sorted set scored by acquisition time,
+    #  so slots held by a worker that died are reclaimed after THROTTLE_SLOT_TIMEOUT
+    key = _concurrency_key(source_name)
+    token = uuid.uuid4().hex
+    while True:
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.zremrangebyscore(key, 0, now - settings.THROTTLE_SLOT_TIMEOUT)
+        pipe.zadd(key, now, token)
+        pipe.zrank(key, token)
+        pipe.expire(key, settings.THROTTLE_SLOT_TIMEOUT)
+        rank = pipe.execute()[2]
+        if rank is not None and rank < concurrency:
+            return token
+        client.zrem(key, token)
+        _sleep(settings.THROTTLE_POLL_INTERVAL, deadline)
+
+
+def _wait_for_rate(client, source_name, requests, period, deadline=None):
+    while True:
+        window = int(time.time() / period)
+        key = 'covers:throttle:{}:rate:{}'.format(source_name, window)
+        pipe = client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, int(period) + 1)
+        count = pipe.execute()[0]
+        if count <= requests:
+            return
+        _sleep(max((window + 1) * period - time.time(), settings.THROTTLE_POLL_INTERVAL), deadline)
+
+
+def _sleep(seconds, deadline):
+    if deadline is not None and time.time() + seconds > deadline:
+        raise SlotTimeout()
+    time.sleep(seconds)
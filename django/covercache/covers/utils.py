@@ -1,72 +1,223 @@
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, Count, Value, When
+
 from covercache import connector
-from .models import Work, Manifestation, Identifier, Cover
+from .models import (
+    Work, Manifestation, Identifier, Cover, Statistic, SyncWatermark, WorkCoverIndex, HarvestQueueEntry)
 
 
-def update_altered_manifestation_ids():
+def update_altered_manifestation_ids(full_resync=False):
     print('update_altered_manifestation_ids')
-    id_mapping = connector.get_altered_manifestation_id_mapping()
-    for manifestation in Manifestation.objects.filter(id__in=id_mapping.keys()):
-        prev_id = manifestation.id
-        try:
-            manifestation = Manifestation.objects.get(id=id_mapping[manifestation.id])
-        except Manifestation.DoesNotExist:
-            manifestation.id = id_mapping[manifestation.id]
-            manifestation.save()
-        identifiers = Manifestation.objects.get(id=prev_id).identifiers.all()
-        manifestation.identifiers.add(*identifiers)
+    since = None
+    if not full_resync:
+        since = SyncWatermark.get_value(SyncWatermark.ALTERED_MANIFESTATION_IDS)
+    id_mapping, latest = connector.get_altered_manifestation_id_mapping(since)
+    Link = Manifestation.identifiers.through
+    with transaction.atomic():
+        old_manifestations = Manifestation.objects.in_bulk(list(id_mapping.keys()))
+        new_ids = {id_mapping[old_id] for old_id in old_manifestations}
+        existing_new_ids = set(Manifestation.objects.filter(
+            id__in=new_ids).values_list('id', flat=True))
+        # a manifestation whose new id is not known yet is copied to it, the old one is left for pruning
+        new_manifestations = {}
+        for old_id, manifestation in old_manifestations.items():
+            new_id = id_mapping[old_id]
+            if new_id not in existing_new_ids and new_id not in new_manifestations:
+                new_manifestations[new_id] = Manifestation(
+                    id=new_id,
+                    date_last_checked=manifestation.date_last_checked,
+                    precedence=manifestation.precedence,
+                    work_id=manifestation.work_id)
+        Manifestation.objects.bulk_create(
+            list(new_manifestations.values()),
+            batch_size=settings.BULK_UPDATE_SIZE)
+        existing_links = set(Link.objects.filter(
+            manifestation_id__in=new_ids).values_list('manifestation_id', 'identifier_id'))
+        wanted_links = {
+            (id_mapping[old_id], identifier_id)
+            for old_id, identifier_id in Link.objects.filter(
+                manifestation_id__in=list(old_manifestations)).values_list('manifestation_id', 'identifier_id')
+        }
+        new_links = wanted_links - existing_links
+        Link.objects.bulk_create(
+            [Link(manifestation_id=manifestation_id, identifier_id=identifier_id)
+             for manifestation_id, identifier_id in new_links],
+            batch_size=settings.BULK_UPDATE_SIZE)
+        if latest:
+            SyncWatermark.set_value(SyncWatermark.ALTERED_MANIFESTATION_IDS, latest)
+    affected_work_ids = set(Manifestation.objects.filter(
+        id__in={manifestation_id for manifestation_id, identifier_id in new_links}).values_list('work_id', flat=True))
+    WorkCoverIndex.refresh(affected_work_ids)
+    print('remapped {} manifestations, created {} manifestations, linked {} identifiers'.format(
+        len(old_manifestations),
+        len(new_manifestations),
+        len(new_links)))
 
 
 def prune_manifestations():
     print('prune_manifestations')
-    connector_manifestation_ids = set([
+    connector_manifestation_ids = {
         manifestation_attributes['manifestation_id']
         for manifestation_attributes
         in connector.get_manifestations()
-    ])
+    }
     local_manifestion_ids = set(Manifestation.objects.values_list('id', flat=True))
     dead_manifestation_ids = local_manifestion_ids - connector_manifestation_ids
-    Manifestation.objects.filter(id__in=dead_manifestation_ids).delete()
+    dead_manifestations = Manifestation.objects.filter(id__in=dead_manifestation_ids)
+    affected_work_ids = set(dead_manifestations.values_list('work_id', flat=True))
+    dead_manifestations.delete()
+    WorkCoverIndex.refresh(affected_work_ids)
 
 
-def update_identifiers():
+def update_identifiers(full_resync=False):
     print('update_identifiers')
-    for manifestation_attributes in connector.get_manifestations():
-        manifestation_id = manifestation_attributes['manifestation_id']
-        date_updated = manifestation_attributes['date_updated']
-        try:
-            manifestation = Manifestation.objects.get(id=manifestation_id)
-        except Manifestation.DoesNotExist:
-            manifestation = Manifestation(
-                id=manifestation_id,
-                precedence=manifestation_attributes.get('precedence', 0))
-            manifestation.save()
-        if not manifestation.date_last_checked or date_updated > manifestation.date_last_checked:
-            manifestation.map_identifiers()
+    latest = None
+    for chunk, latest in get_identifier_chunks(full_resync):
+        update_identifiers_chunk(chunk)
+    finish_update_identifiers(latest)
+
+
+def get_identifier_chunks(full_resync=False):
+    """
+    yields the manifestations modified since the last sync in chunks of consecutive ids as they stream in,
+    each along with the latest modification date seen so far
+    """
+    modified_since = None
+    if not full_resync:
+        modified_since = SyncWatermark.get_value(SyncWatermark.MANIFESTATIONS)
+    latest = modified_since
+    chunk = []
+    for manifestation_attributes in connector.get_manifestations(modified_since):
+        if not latest or manifestation_attributes['date_updated'] > latest:
+            latest = manifestation_attributes['date_updated']
+        chunk.append(manifestation_attributes)
+        if len(chunk) >= settings.CONNECTOR_BATCH_SIZE:
+            yield chunk, latest
+            chunk = []
+    if chunk:
+        yield chunk, latest
+
+
+def finish_update_identifiers(latest):
+    if latest:
+        SyncWatermark.set_value(SyncWatermark.MANIFESTATIONS, latest)
+
+
+def update_identifiers_chunk(chunk):
+    attributes_by_id = {
+        manifestation_attributes['manifestation_id']: manifestation_attributes
+        for manifestation_attributes in chunk
+    }
+    manifestations = Manifestation.objects.in_bulk(list(attributes_by_id.keys()))
+    new_manifestations = [
+        Manifestation(
+            id=manifestation_id,
+            precedence=manifestation_attributes.get('precedence', 0))
+        for manifestation_id, manifestation_attributes in attributes_by_id.items()
+        if manifestation_id not in manifestations
+    ]
+    Manifestation.objects.bulk_create(new_manifestations)
+    manifestations.update({
+        manifestation.id: manifestation
+        for manifestation in new_manifestations
+    })
+    changed_manifestation_ids = [
+        manifestation_id
+        for manifestation_id, manifestation in manifestations.items()
+        if not manifestation.date_last_checked
+        or attributes_by_id[manifestation_id]['date_updated'] > manifestation.date_last_checked
+    ]
+    Manifestation.map_identifiers_batch({
+        manifestations[manifestation_id]: identifier_attributes
+        for manifestation_id, identifier_attributes in connector.get_identifiers_batch(changed_manifestation_ids)
+    })
 
 
 def update_works():
     print('update_works')
-    for k, v in connector.get_works().items():
-        try:
-            manifestation = Manifestation.objects.get(id=k)
-        except Manifestation.DoesNotExist:
-            manifestation = None
-        if manifestation:
-            try:
-                work = Work.objects.get(id=v)
-            except Work.DoesNotExist:
-                work = Work(id=v)
-                work.save()
-            manifestation.work = work
-            manifestation.save()
+    work_mapping = connector.get_works()
+    local_work_mapping = dict(Manifestation.objects.values_list('id', 'work_id'))
+    changed_work_mapping = {
+        manifestation_id: work_id
+        for manifestation_id, work_id in work_mapping.items()
+        if manifestation_id in local_work_mapping
+        and local_work_mapping[manifestation_id] != work_id
+    }
+    existing_work_ids = set(Work.objects.values_list('id', flat=True))
+    new_works = [
+        Work(id=work_id)
+        for work_id in set(changed_work_mapping.values()) - existing_work_ids
+    ]
+    Work.objects.bulk_create(new_works, batch_size=settings.BULK_UPDATE_SIZE)
+    WorkCoverIndex.objects.bulk_create(
+        [WorkCoverIndex(work=work) for work in new_works],
+        batch_size=settings.BULK_UPDATE_SIZE)
+    manifestation_ids = sorted(changed_work_mapping.keys())
+    for i in range(0, len(manifestation_ids), settings.BULK_UPDATE_SIZE):
+        chunk = manifestation_ids[i:i + settings.BULK_UPDATE_SIZE]
+        with transaction.atomic():
+            Manifestation.objects.filter(id__in=chunk).update(work_id=Case(
+                *[When(id=manifestation_id, then=Value(changed_work_mapping[manifestation_id]))
+                  for manifestation_id in chunk],
+                output_field=models.IntegerField()))
+        # both the works the manifestations left and the works they joined may have gained or lost covers
+        WorkCoverIndex.refresh(
+            [local_work_mapping[manifestation_id] for manifestation_id in chunk]
+            + [changed_work_mapping[manifestation_id] for manifestation_id in chunk])
+    print('created {} works, relinked {} manifestations'.format(
+        len(new_works),
+        len(manifestation_ids)))
+
 
+def refresh_stats():
+    print('refresh_stats')
+    values = {
+        'works': Work.objects.count(),
+        'manifestations': Manifestation.objects.count(),
+        'identifiers': Identifier.objects.count(),
+        'covers': Cover.objects.count(),
+        'works_with_covers': WorkCoverIndex.objects.filter(has_cover=True).count(),
+        'works_with_no_way_to_get_covers': Work.objects.exclude(
+            manifestations__identifiers__isnull=False).count(),
+    }
+    for source in settings.SOURCE_PRECEDENCE:
+        values[Statistic.get_name('covers_by_source', source)] = 0
+    grouped_querysets = [
+        ('identifiers_by_source', Identifier.objects.all()),
+        ('worthless_identifiers_by_source', Identifier.objects.filter(
+            manifestations__work__cover_index__has_cover=False)),
+        ('covers_by_source', Cover.objects.all()),
+    ]
+    for group, queryset in grouped_querysets:
+        for row in queryset.values('source').annotate(count=Count('id', distinct=True)).order_by():
+            values[Statistic.get_name(group, row['source'])] = row['count']
+    Statistic.replace_all(values)
 
-def try_to_download_covers():
+
+def try_to_download_covers(work_ids=None):
+    """
+    returns the number of covers found per source,
+    taking the next batch of works off the harvest queue unless work_ids are given
+    """
     print('try_to_download_cover')
-    coverless_works = Work.objects.exclude(
-        manifestations__in=(Manifestation.objects.filter(
-            identifiers__in=Identifier.objects.filter(
-                covers__in=Cover.objects.all())))).order_by('?')
-    for work in coverless_works:
-        print(work.id)
-        work.try_to_download_cover()
+    if work_ids is None:
+        work_ids = HarvestQueueEntry.dequeue(settings.HARVEST_CHUNK_SIZE)
+    covers_by_source = {}
+    works = Work.objects.in_bulk(work_ids)
+    try:
+        for work_id in work_ids:
+            if work_id not in works:
+                continue
+            print(work_id)
+            try:
+                cover = works[work_id].try_to_download_cover()
+            except Exception as e:
+                # one broken work must not lose the rest of the chunk, nor fail the harvest chord
+                print('failed to harvest work {}: {!r}'.format(work_id, e))
+                continue
+            if cover:
+                covers_by_source[cover.source] = covers_by_source.get(cover.source, 0) + 1
+    finally:
+        HarvestQueueEntry.release(work_ids)
+    return covers_by_source
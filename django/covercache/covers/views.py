@@ -3,12 +3,14 @@ from rest_framework.viewsets import ViewSet
 from rest_framework.response import Response
 from rest_framework.decorators import detail_route, list_route
 from rest_framework import status
-from rest_framework_extensions.cache.decorators import cache_response
 
 from collections import OrderedDict
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
-from .models import Work, Manifestation, Identifier, Cover
+from . import utils
+from .models import Work, Identifier, Cover, HarvestQueueEntry, Statistic, WorkCoverIndex
 from .sources import Staff
 from .serializers import WorkSerializer, CoverSerializer
 
@@ -16,25 +18,126 @@ from .serializers import WorkSerializer, CoverSerializer
 class WorkViewSet(ViewSet):
     queryset = Work.objects.all()
 
-    def _calculate_cache_key(view_instance, view_method, request, args, kwargs):
-        return request.path
-
     def retrieve(self, request, pk=None):
         try:
-            work = Work.objects.get(pk=pk)
-        except Work.DoesNotExist:
+            index = WorkCoverIndex.objects.get(pk=pk)
+        except WorkCoverIndex.DoesNotExist:
+            # works from before the index existed are indexed on first request
+            index = WorkCoverIndex.refresh(
+                Work.objects.filter(pk=pk).values_list('pk', flat=True)).get(int(pk))
+        if index is None:
             resp = {
                 "covers": [],
                 "success": False
             }
             return Response(resp, status=status.HTTP_404_NOT_FOUND)
-        covers = CoverSerializer(work.get_covers(), many=True)
+        if not index.has_cover:
+            # works people ask for are harvested first
+            HarvestQueueEntry.increment_demand(index.work_id)
+        covers = CoverSerializer(index.get_covers(), many=True)
         resp = {
             "covers": covers.data,
             "success": True
         }
         return Response(resp, status=status.HTTP_200_OK)
 
+    @list_route(methods=['get', 'post'])
+    def batch(self, request):
+        """
+        returns the covers of many works at once, given as ids=1,2,3 or a JSON body of {"ids": [1, 2, 3]}
+        """
+        if request.method == 'POST':
+            if not isinstance(request.data, dict):
+                return Response({"success": False}, status=status.HTTP_400_BAD_REQUEST)
+            ids = request.data.get('ids', [])
+            if not isinstance(ids, list):
+                return Response({"success": False}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            ids = [i for i in request.query_params.get('ids', '').split(',') if i]
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            return Response({"success": False}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > settings.BATCH_LOOKUP_LIMIT:
+            return Response({"success": False}, status=status.HTTP_400_BAD_REQUEST)
+
+        indexes = WorkCoverIndex.objects.in_bulk(ids)
+        unindexed_ids = [i for i in ids if i not in indexes]
+        if unindexed_ids:
+            # works from before the index existed are indexed on first request
+            indexes.update(WorkCoverIndex.refresh(
+                Work.objects.filter(pk__in=unindexed_ids).values_list('pk', flat=True)))
+        covers_by_work = WorkCoverIndex.get_covers_by_work(indexes.values())
+
+        works = OrderedDict()
+        for i in ids:
+            works[str(i)] = {
+                "covers": CoverSerializer(covers_by_work.get(i, []), many=True).data,
+                "success": i in indexes
+            }
+        resp = {
+            "works": works,
+            "success": True
+        }
+        return Response(resp, status=status.HTTP_200_OK)
+
+    def cover(self, request, pk=None):
+        """
+        hands the best cover of the work, or the placeholder, to nginx to serve
+        """
+        width = request.query_params.get('width')
+        if width is not None:
+            try:
+                width = int(width)
+            except ValueError:
+                return HttpResponseBadRequest()
+            if width not in settings.COVER_RENDITION_WIDTHS:
+                return HttpResponseBadRequest()
+
+        cover = None
+        try:
+            index = WorkCoverIndex.objects.get(pk=pk)
+        except WorkCoverIndex.DoesNotExist:
+            # works from before the index existed are indexed on first request
+            index = WorkCoverIndex.refresh(
+                Work.objects.filter(pk=pk).values_list('pk', flat=True)).get(int(pk))
+        if index and index.cover_ids:
+            cover = Cover.objects.filter(pk=index.cover_ids[0]).first()
+        if cover is None:
+            if not settings.PLACEHOLDER_COVER:
+                return HttpResponseNotFound()
+            return self._accel_redirect(settings.PLACEHOLDER_COVER)
+
+        name = cover.image.name
+        if width:
+            name = cover.get_rendition_name(width)
+            if name is None:
+                cover.request_rendition(width)
+                # the full size image stands in, uncached, until the rendition has been made
+                response = self._accel_redirect(cover.image.name)
+                response['Cache-Control'] = 'no-cache'
+                return response
+
+        last_modified = int(cover.date_modified.timestamp())
+        # parse_etags returns the etags unquoted, so the etag is only quoted for the header
+        etag = '{}-{}-{}'.format(cover.pk, last_modified, width or 0)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if (if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*')) or (
+                not if_none_match and if_modified_since and if_modified_since >= last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = self._accel_redirect(name)
+        response['ETag'] = quote_etag(etag)
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def _accel_redirect(self, name):
+        response = HttpResponse(content_type='image/jpeg')
+        response['X-Accel-Redirect'] = settings.X_ACCEL_REDIRECT_PREFIX + name
+        response['Cache-Control'] = 'public, max-age={}'.format(settings.COVER_MAX_AGE)
+        return response
+
     @detail_route(methods=['post'])
     def poll_sources(self, request, pk=None):
         try:
@@ -43,7 +146,7 @@ class WorkViewSet(ViewSet):
             return Response({}, status=status.HTTP_404_NOT_FOUND)
 
         if not work.has_cover():
-            work.try_to_download_cover()
+            work.try_to_download_cover(concurrent=True)
         return Response({}, status=status.HTTP_200_OK)
 
     @detail_route(methods=['post'])
@@ -81,11 +184,13 @@ class WorkViewSet(ViewSet):
             # if the identifier existed before the request
             covers = identifier.covers.all()
         if not covers:
+            identifier.save()
             source = Staff()
             identifier.try_to_download_cover(source)
             covers = identifier.covers.all()
         if covers:
             manifestation.identifiers.add(identifier)
+            WorkCoverIndex.refresh([work.id])
             resp = CoverSerializer(covers, many=True).data
             return Response(resp, status=status.HTTP_200_OK)
         else:
@@ -94,59 +199,52 @@ class WorkViewSet(ViewSet):
 
     @list_route(methods=['get'])
     def stats(self, request):
-        works_with_covers = Work.objects.filter(
-            manifestations__identifiers__covers__isnull=False).count()
-        works_with_no_way_to_get_covers = Work.objects.filter(
-            manifestations__identifiers=None).exclude(
-                manifestations__in=Manifestation.objects.exclude(
-                    identifiers=None)).count()
-        covers_by_source = OrderedDict([
-            (source, Cover.objects.filter(source=source).count())
-            for source in settings.SOURCE_PRECEDENCE
-        ])
-        identifiers_by_source = {
-            source: Identifier.objects.filter(source=source).count()
-            for source
-            in Identifier.objects.values_list('source', flat=True).distinct()
-        }
-        works_with_no_covers = Work.objects.exclude(
-            manifestations__identifiers__covers__isnull=False)
-        identifiers_of_works_with_no_covers = Identifier.objects.filter(
-            manifestations__work__in=works_with_no_covers)
-        worthless_identifiers_by_source = {
-            source: identifiers_of_works_with_no_covers.filter(
-                source=source).count()
-            for source
-            in Identifier.objects.values_list('source', flat=True).distinct()
-        }
+        snapshot, as_of = Statistic.get_snapshot()
+        if as_of is None:
+            utils.refresh_stats()
+            snapshot, as_of = Statistic.get_snapshot()
 
         resp = OrderedDict([
-            ('works', Work.objects.all().count()),
-            ('manifestations', Manifestation.objects.all().count()),
-            ('identifiers', Identifier.objects.all().count()),
-            ('covers', Cover.objects.all().count()),
-            ('works_with_covers', works_with_covers),
-            ('works_with_no_way_to_get_covers', works_with_no_way_to_get_covers),
-            ('identifiers_by_source', identifiers_by_source),
-            ('worthless_identifiers_by_source', worthless_identifiers_by_source),
-            ('covers_by_source', covers_by_source)
+            (name, snapshot.get(name, {} if name in Statistic.GROUPED else 0))
+            for name in [
+                'works',
+                'manifestations',
+                'identifiers',
+                'covers',
+                'works_with_covers',
+                'works_with_no_way_to_get_covers',
+                'identifiers_by_source',
+                'worthless_identifiers_by_source',
+                'covers_by_source',
+            ]
         ])
+        resp['covers_by_source'] = OrderedDict([
+            (source, resp['covers_by_source'].get(source, 0))
+            for source in settings.SOURCE_PRECEDENCE
+        ])
+        resp['as_of'] = as_of
         return Response(resp, status=status.HTTP_200_OK)
 
     @detail_route(methods=['get'])
-    @cache_response(
-        settings.RECOMMENDATIONS['cache_response_timeout'],
-        key_func=_calculate_cache_key
-    )
     def recommendations(self, request, pk=None):
         try:
             work = Work.objects.get(pk=pk)
         except Work.DoesNotExist:
             return Response({}, status=status.HTTP_404_NOT_FOUND)
 
-        recommendations = WorkSerializer(work.get_recommendations(), many=True)
+        # serves what is stored, refreshing it in the background for later requests
+        if work.recommendations_are_stale():
+            work.request_recommendations_refresh()
+        recommended_works = list(work.get_recommendations())
+        covers_by_work = WorkCoverIndex.get_covers_by_work(
+            WorkCoverIndex.objects.filter(work__in=recommended_works))
+        recommendations = WorkSerializer(
+            recommended_works,
+            many=True,
+            context={'covers_by_work': covers_by_work})
         resp = {
             "recommendations": recommendations.data,
-            "success": True
+            "success": True,
+            "as_of": work.date_recommendations_refreshed
         }
         return Response(resp, status=status.HTTP_200_OK)